@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the database work done by inline_search under concurrent load.
+
+Every simulated inline query does what the bot does before answering:
+handle_user() followed by update_statistics(), plus a fixed sleep standing in
+for the Yandex Music round trips. The "sync" mode runs the old blocking
+Session(engine) code path inside the event loop, the "async" mode uses the
+pooled AsyncEngine from src.database.session.
+
+Requires a reachable DATABASE_URL. Benchmark users are created with ids above
+BENCH_USER_ID_BASE and removed afterwards.
+
+Usage:
+    python -m benchmarks.db_throughput --queries 2000 --concurrency 100
+"""
+
+import argparse
+import asyncio
+import time
+
+from sqlalchemy import delete
+from sqlmodel import Session, select
+
+from src.database.session import engine, init_db, close_db
+from src.database.user_operations import handle_user
+from src.database.statistics_operations import update_statistics
+from src.models.user import User
+from src.models.statistics import Statistics
+
+BENCH_USER_ID_BASE = 9_000_000_000_000
+
+
+async def sync_inline_query(user_id: int) -> None:
+    """The pre-AsyncEngine code path: blocking sessions on the event loop."""
+    with Session(engine) as session:
+        user = session.exec(select(User).where(User.id == user_id)).first()
+        if not user:
+            session.add(User(id=user_id))
+            session.commit()
+    with Session(engine) as session:
+        stats = session.exec(select(Statistics)).all()
+        if stats:
+            latest = max(stats, key=lambda x: x.id or 0)
+            latest.total_requests += 1
+            latest.daily_requests += 1
+            session.add(latest)
+            session.commit()
+
+
+async def async_inline_query(user_id: int) -> None:
+    await handle_user(user_id)
+    await update_statistics(total_requests=1, daily_requests=1)
+
+
+async def run(mode: str, queries: int, concurrency: int, users: int, upstream_ms: float) -> float:
+    handler = sync_inline_query if mode == 'sync' else async_inline_query
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        async with semaphore:
+            await handler(BENCH_USER_ID_BASE + i % users)
+            # Stand-in for the Yandex Music calls made after the DB work
+            await asyncio.sleep(upstream_ms / 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(queries)))
+    elapsed = time.perf_counter() - started
+    return queries / elapsed
+
+
+def cleanup() -> None:
+    with Session(engine) as session:
+        session.exec(delete(User).where(User.id >= BENCH_USER_ID_BASE))
+        session.commit()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--upstream-ms', type=float, default=50.0)
+    parser.add_argument('--mode', choices=['sync', 'async', 'both'], default='both')
+    args = parser.parse_args()
+
+    await init_db()
+    try:
+        modes = ['sync', 'async'] if args.mode == 'both' else [args.mode]
+        for mode in modes:
+            cleanup()
+            qps = await run(mode, args.queries, args.concurrency, args.users, args.upstream_ms)
+            print(f"{mode:>5}: {qps:8.1f} inline queries/sec "
+                  f"({args.queries} queries, concurrency {args.concurrency})")
+    finally:
+        cleanup()
+        await close_db()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,297 @@
+"""
+Local stand-ins for the Telegram Bot API, the Yandex Music API and Ynison.
+
+Each fake has its own latency, jitter and error rate, so slow or failing
+upstreams can be simulated. FakeServers.env() returns
+the environment variables that point the bot at them; they must be set before
+src modules are imported.
+"""
+
+import asyncio
+import json
+import logging
+import random
+import socket
+import time
+from typing import Dict, List, Optional
+
+from aiohttp import WSMsgType, web
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class FakeService:
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, error_rate: float = 0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+
+    async def delay(self) -> None:
+        latency = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if latency > 0:
+            await asyncio.sleep(latency / 1000)
+
+    def fail(self) -> bool:
+        """Count a request and decide whether to inject an error into it."""
+        self.requests += 1
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+
+class FakeTelegram(FakeService):
+    """Answers every Bot API method with a canned success and counts the calls.
+
+    Injected errors are flood-control responses with a short retry_after.
+    """
+
+    def __init__(self, *args, retry_after: int = 1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.retry_after = retry_after
+        self.calls: Dict[str, int] = {}
+        # inline_query_id -> time.perf_counter() of its answer
+        self.inline_answers: Dict[str, float] = {}
+        self.webhook_set = asyncio.Event()
+        self._waiters: List = []
+
+    def setup(self, app: web.Application) -> None:
+        app.router.add_post('/bot{token}/{method}', self.handle)
+
+    def count(self, method: str) -> int:
+        return self.calls.get(method.lower(), 0)
+
+    async def wait_for(self, method: str, count: int) -> None:
+        """Wait until method has been called count times."""
+        while self.count(method) < count:
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.append(future)
+            await future
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method'].lower()
+        await self.delay()
+        if method not in ('getme', 'setwebhook') and self.fail():
+            return web.json_response({
+                'ok': False, 'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            })
+        self.calls[method] = self.calls.get(method, 0) + 1
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            waiter.set_result(None)
+
+        if method == 'getme':
+            result = {'id': 123456, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif method == 'answerinlinequery':
+            data = await request.post()
+            self.inline_answers[str(data.get('inline_query_id'))] = time.perf_counter()
+            result = True
+        elif method in ('sendmessage', 'editmessagetext'):
+            data = await request.post()
+            result = {
+                'message_id': self.calls[method],
+                'date': int(time.time()),
+                'chat': {'id': int(data.get('chat_id', 1)), 'type': 'private'},
+                'text': data.get('text', ''),
+            }
+        else:
+            if method == 'setwebhook':
+                self.webhook_set.set()
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+
+def make_track(track_id: int) -> Dict:
+    return {
+        'id': str(track_id),
+        'title': f'Track {track_id}',
+        'artists': [{'id': track_id % 97, 'name': f'Artist {track_id % 97}'}],
+        'albums': [{'id': track_id // 10}],
+        'durationMs': 180000 + track_id % 60000,
+        'available': True,
+    }
+
+
+class FakeYandexMusic(FakeService):
+    """The Yandex Music REST endpoints the bot uses through ClientAsync. Injected errors are HTTP 500s."""
+
+    def __init__(self, *args, results: int = 10, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.results = results
+        self.base_url = ''
+
+    def setup(self, app: web.Application, prefix: str = '/yandex') -> None:
+        app.router.add_get(f'{prefix}/account/status', self.account_status)
+        app.router.add_get(f'{prefix}/search', self.search)
+        app.router.add_get(f'{prefix}/tracks/{{track_id}}/download-info', self.download_info)
+        app.router.add_get(f'{prefix}/download/{{track_id}}/{{bitrate}}', self.direct_link_xml)
+        app.router.add_post(f'{prefix}/tracks', self.tracks)
+
+    async def _respond(self, result) -> web.Response:
+        await self.delay()
+        if self.fail():
+            return web.json_response({'error': 'internal', 'error_description': 'injected'}, status=500)
+        return web.json_response({'result': result})
+
+    async def account_status(self, request: web.Request) -> web.Response:
+        token = request.headers.get('Authorization', '')
+        uid = abs(hash(token)) % 10 ** 9
+        return await self._respond({
+            'account': {'now': time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime()), 'uid': uid,
+                        'login': f'user{uid}', 'serviceAvailable': True},
+            'permissions': {'until': '2100-01-01T00:00:00+00:00', 'values': [], 'default': []},
+        })
+
+    async def search(self, request: web.Request) -> web.Response:
+        text = request.query.get('text', '')
+        # The same text always finds the same tracks
+        base = abs(hash(text)) % 10 ** 6 * 100
+        tracks = [make_track(base + n) for n in range(self.results)]
+        return await self._respond({
+            'text': text, 'page': 0, 'perPage': self.results, 'searchRequestId': 'bench',
+            'tracks': {'total': self.results, 'perPage': self.results, 'order': 0, 'results': tracks},
+        })
+
+    async def download_info(self, request: web.Request) -> web.Response:
+        track_id = request.match_info['track_id']
+        return await self._respond([
+            {
+                'codec': 'mp3', 'bitrateInKbps': bitrate, 'gain': False, 'preview': False, 'direct': False,
+                'downloadInfoUrl': f'{self.base_url}/download/{track_id}/{bitrate}',
+            }
+            for bitrate in (320, 192)
+        ])
+
+    async def direct_link_xml(self, request: web.Request) -> web.Response:
+        await self.delay()
+        if self.fail():
+            return web.Response(status=500)
+        track_id, bitrate = request.match_info['track_id'], request.match_info['bitrate']
+        return web.Response(text=(
+            '<?xml version="1.0" encoding="utf-8"?><download-info>'
+            '<host>cdn.example.invalid</host>'
+            f'<path>/music/{track_id}/{bitrate}.mp3</path>'
+            f'<ts>{int(time.time())}</ts><region>0</region><s>bench</s>'
+            '</download-info>'
+        ), content_type='text/xml')
+
+    async def tracks(self, request: web.Request) -> web.Response:
+        data = await request.post()
+        # Sent as one comma-separated field or as repeated fields
+        ids = ','.join(str(value) for value in data.getall('track-ids', [])).split(',')
+        return await self._respond([make_track(int(track_id)) for track_id in ids if track_id.isdigit()])
+
+
+class FakeYnison(FakeService):
+    """Ynison redirector and state websockets, pushing a playing track for every token.
+
+    Injected errors reject the websocket handshake.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.host = ''
+
+    def setup(self, app: web.Application, prefix: str = '/ynison') -> None:
+        app.router.add_get(f'{prefix}/redirect', self.redirect)
+        app.router.add_get(f'{prefix}/state', self.state)
+
+    async def _prepare(self, request: web.Request) -> Optional[web.WebSocketResponse]:
+        await self.delay()
+        if self.fail():
+            return None
+        ws = web.WebSocketResponse(protocols=('Bearer',))
+        await ws.prepare(request)
+        return ws
+
+    async def redirect(self, request: web.Request):
+        ws = await self._prepare(request)
+        if ws is None:
+            return web.Response(status=500)
+        await ws.send_str(json.dumps({'host': self.host, 'redirect_ticket': 'bench', 'session_id': '1'}))
+        await ws.close()
+        return ws
+
+    async def state(self, request: web.Request):
+        ws = await self._prepare(request)
+        if ws is None:
+            return web.Response(status=500)
+        token = request.headers.get('Authorization', '')
+        track_id = abs(hash(token)) % 10 ** 6
+        async for msg in ws:
+            if msg.type != WSMsgType.TEXT:
+                break
+            await ws.send_str(json.dumps({
+                'player_state': {
+                    'player_queue': {
+                        'current_playable_index': 0,
+                        'playable_list': [{'playable_id': str(track_id), 'playable_type': 'TRACK'}],
+                        'entity_id': 'bench',
+                        'entity_type': 'VARIOUS',
+                        'options': {'repeat_mode': 'NONE'},
+                    },
+                    'status': {'paused': False, 'duration_ms': 200000, 'progress_ms': 1000},
+                },
+            }))
+        return ws
+
+
+class FakeServers:
+    """Runs each fake on its own port, like the separate hosts they stand in for.
+
+    With shared_host all fakes answer on one port instead, so Ynison websockets and
+    REST requests go to the same host and compete for its connections.
+    """
+
+    def __init__(self, telegram: FakeTelegram, yandex: FakeYandexMusic, ynison: FakeYnison,
+                 shared_host: bool = False):
+        self.telegram = telegram
+        self.yandex = yandex
+        self.ynison = ynison
+        self.shared_host = shared_host
+        if shared_host:
+            port = free_port()
+            self.ports = {'telegram': port, 'yandex': port, 'ynison': port}
+        else:
+            self.ports = {'telegram': free_port(), 'yandex': free_port(), 'ynison': free_port()}
+        self._runners: List[web.AppRunner] = []
+
+    def url(self, service: str, scheme: str = 'http') -> str:
+        return f'{scheme}://127.0.0.1:{self.ports[service]}'
+
+    def env(self) -> Dict[str, str]:
+        return {
+            'TELEGRAM_API_URL': self.url('telegram'),
+            'YANDEX_MUSIC_API_URL': f"{self.url('yandex')}/yandex",
+            'YNISON_REDIRECT_URL': f"{self.url('ynison', 'ws')}/ynison/redirect",
+            'YNISON_STATE_URL': 'ws://{host}/ynison/state',
+        }
+
+    async def start(self) -> None:
+        # Superseded inline queries cancel their requests, the resulting disconnects are expected
+        logging.getLogger('aiohttp.server').setLevel(logging.CRITICAL)
+        self.yandex.base_url = f"{self.url('yandex')}/yandex"
+        self.ynison.host = f"127.0.0.1:{self.ports['ynison']}"
+        services = (('telegram', self.telegram), ('yandex', self.yandex), ('ynison', self.ynison))
+        groups = [services] if self.shared_host else [(service,) for service in services]
+        for group in groups:
+            app = web.Application()
+            for _, service in group:
+                service.setup(app)
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, '127.0.0.1', self.ports[group[0][0]]).start()
+            self._runners.append(runner)
+
+    async def close(self) -> None:
+        for runner in self._runners:
+            await runner.cleanup()
+        self._runners = []
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+Inline traffic load generator that replays realistic typing sessions.
+
+Feeds inline query updates into the real dispatcher, as polling does, at a target
+rate against the local fakes from benchmarks.fakes. Synthetic traffic is made of
+sessions:
+
+- now-playing sessions: a user opens the inline menu with an empty query, sometimes
+  several times a few seconds apart
+- typing sessions: a user types a search term one keystroke at a time, so Telegram
+  sends every growing prefix ("m", "mo", "mor", ...); terms follow a Zipf popularity
+
+A recorded stream can be replayed instead with --replay: JSON lines like
+{"t": 1.25, "user": "a1b2", "query": "mor"}, where t is seconds from the start and
+user is any anonymized id (each distinct one becomes a benchmark user). --record
+writes the generated stream in the same format.
+
+Reports answer latency, answers that never came (superseded by a newer query of
+the same user, or dropped), answers later than Telegram waits for, handler queue
+depth, admission control (queries waiting for a slot, degraded to cache-only
+answers, expired) and upstream requests per inline query.
+
+Usage:
+    python -m benchmarks.inline_load --rate 100 --duration 30 --users 300 --yandex-latency-ms 80
+    python -m benchmarks.inline_load --replay queries.jsonl --rate 200
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from benchmarks.offline_suite import (
+    BENCH_USER_ID_BASE, BOT_TOKEN, WORDS, add_fake_arguments, create_users, percentile, start_fakes,
+)
+
+# A newer query from the same user within this gap continues the same burst of typing
+BURST_GAP = 1.0
+
+
+@dataclass
+class Event:
+    at: float
+    user: int
+    query: str
+
+
+def zipf_terms(vocabulary: int, exponent: float) -> Tuple[List[str], List[float]]:
+    """Search terms and their Zipf popularity weights."""
+    terms = [f'{WORDS[rank % len(WORDS)]} {rank}' for rank in range(vocabulary)]
+    weights = [1 / (rank + 1) ** exponent for rank in range(vocabulary)]
+    return terms, weights
+
+
+def keystroke_gap(rng: random.Random) -> float:
+    """Seconds between two keystrokes, heavy-tailed around 0.2 s."""
+    return min(rng.lognormvariate(-1.7, 0.5), 2.0)
+
+
+def synthetic_events(args, rng: random.Random) -> List[Event]:
+    terms, weights = zipf_terms(args.vocabulary, args.zipf)
+    events: List[Event] = []
+    # Start earlier so that traffic is already in its steady state at 0
+    started = -10.0
+    while started < args.duration:
+        user = rng.randrange(args.users)
+        session: List[Event] = []
+        if rng.random() < args.now_share:
+            at = started
+            for _ in range(rng.choice((1, 1, 2, 3))):
+                session.append(Event(at, user, ''))
+                at += rng.uniform(2, 8)
+        else:
+            term = rng.choices(terms, weights)[0]
+            at = started
+            for length in range(1, len(term) + 1):
+                session.append(Event(at, user, term[:length]))
+                at += keystroke_gap(rng)
+        events.extend(event for event in session if 0 <= event.at < args.duration)
+        # Sessions arrive as a Poisson process whose query rate averages args.rate
+        started += rng.expovariate(args.rate / len(session))
+    events.sort(key=lambda event: event.at)
+    return events
+
+
+def replay_events(path: str, rate: Optional[float]) -> List[Event]:
+    users: Dict[str, int] = {}
+    events: List[Event] = []
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            user = users.setdefault(str(record['user']), len(users))
+            events.append(Event(float(record['t']), user, record.get('query', '')))
+    events.sort(key=lambda event: event.at)
+    if events:
+        first = events[0].at
+        span = events[-1].at - first
+        scale = len(events) / rate / span if rate and span else 1.0
+        for event in events:
+            event.at = (event.at - first) * scale
+    return events
+
+
+def record_events(path: str, events: List[Event]) -> None:
+    with open(path, 'w', encoding='utf-8') as file:
+        for event in events:
+            file.write(json.dumps({'t': round(event.at, 3), 'user': event.user, 'query': event.query},
+                                  ensure_ascii=False) + '\n')
+
+
+def make_update(n: int, event: Event):
+    from aiogram.types import InlineQuery, Update, User
+
+    user = User(id=BENCH_USER_ID_BASE + event.user, is_bot=False, first_name='Bench')
+    query = InlineQuery(id=str(n), from_user=user, query=event.query, offset='')
+    return Update(update_id=n + 1, inline_query=query)
+
+
+async def generate(app, events: List[Event], args, servers) -> None:
+    from src.services.admission import inline_admission
+    from src.services.http import http_pool
+    from src.services.inline_queries import inline_tracker
+
+    sent: Dict[str, float] = {}
+    lags: List[float] = []
+    errors = 0
+    handlers: set = set()
+    depth: List[int] = []
+    in_flight: List[int] = []
+    connections: List[int] = []
+    waiting: List[int] = []
+
+    async def handle(update) -> None:
+        nonlocal errors
+        try:
+            await app.dp.feed_update(app.bot, update)
+        except Exception:
+            errors += 1
+
+    async def sample() -> None:
+        while True:
+            depth.append(len(handlers))
+            in_flight.append(inline_tracker.stats()['in_flight'])
+            connections.append(http_pool.stats()['in_use'])
+            waiting.append(inline_admission.stats()['waiting'])
+            await asyncio.sleep(0.1)
+
+    admission_before = inline_admission.stats()
+    before = (servers.telegram.requests, servers.yandex.requests, servers.ynison.requests)
+    sampler = asyncio.create_task(sample())
+    started = time.perf_counter()
+    for n, event in enumerate(events):
+        delay = started + event.at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        now = time.perf_counter()
+        lags.append(now - started - event.at)
+        sent[str(n)] = now
+        task = asyncio.create_task(handle(make_update(n, event)))
+        handlers.add(task)
+        task.add_done_callback(handlers.discard)
+    if handlers:
+        await asyncio.wait(set(handlers), timeout=args.deadline * 2)
+    elapsed = time.perf_counter() - started
+    sampler.cancel()
+
+    # Gap to the next query of the same user, None for the last one
+    gaps: List[Optional[float]] = [None] * len(events)
+    last_seen: Dict[int, float] = {}
+    for n in range(len(events) - 1, -1, -1):
+        event = events[n]
+        if event.user in last_seen:
+            gaps[n] = last_seen[event.user] - event.at
+        last_seen[event.user] = event.at
+
+    answers = servers.telegram.inline_answers
+    latencies: List[float] = []
+    final_latencies: List[float] = []
+    superseded = dropped = late = 0
+    for n, event in enumerate(events):
+        answered = answers.get(str(n))
+        final = gaps[n] is None or gaps[n] > BURST_GAP
+        if answered is None:
+            # A newer query of the user before the deadline cancels the old one
+            if gaps[n] is not None and gaps[n] < args.deadline:
+                superseded += 1
+            else:
+                dropped += 1
+            continue
+        latency = answered - sent[str(n)]
+        latencies.append(latency)
+        if final:
+            final_latencies.append(latency)
+        if latency > args.deadline:
+            late += 1
+
+    count = len(events)
+    upstream = [after - before_ for after, before_ in
+                zip((servers.telegram.requests, servers.yandex.requests, servers.ynison.requests), before)]
+    print(f'{count} inline queries in {elapsed:.1f}s ({count / elapsed:.1f}/s), '
+          f'{sum(1 for event in events if not event.query)} empty, {len({e.user for e in events})} users')
+    print(f'answered {len(latencies)}, superseded {superseded}, dropped {dropped}, '
+          f'late (> {args.deadline:g}s) {late}, handler errors {errors}')
+    for name, values in (('all answers', latencies), ('end of typing', final_latencies)):
+        if values:
+            values.sort()
+            print(f'{name:>14}: p50 {statistics.median(values) * 1000:7.1f} ms, '
+                  f'p95 {percentile(values, 0.95) * 1000:7.1f} ms, p99 {percentile(values, 0.99) * 1000:7.1f} ms')
+    lags.sort()
+    print(f'generator lag: p99 {percentile(lags, 0.99) * 1000:.1f} ms')
+    if depth:
+        print(f'handler queue: max {max(depth)}, mean {statistics.mean(depth):.1f}; '
+              f'queries in flight max {max(in_flight)}; pooled connections in use max {max(connections)}')
+        admission = inline_admission.stats()
+        print(f'admission: waiting max {max(waiting)}, mean {statistics.mean(waiting):.1f}; ' + ', '.join(
+            f'{name} {admission[name] - admission_before[name]}' for name in ('waited', 'degraded', 'expired')))
+    print('upstream requests per inline query: ' + ', '.join(
+        f'{name} {value / count:.2f}' for name, value in zip(('telegram', 'yandex', 'ynison'), upstream)))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rate', type=float, default=None, help='inline queries per second (default 50 synthetic)')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of synthetic traffic')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--now-share', type=float, default=0.4, help='share of now-playing sessions')
+    parser.add_argument('--vocabulary', type=int, default=500, help='distinct search terms')
+    parser.add_argument('--zipf', type=float, default=1.1, help='exponent of the search term popularity')
+    parser.add_argument('--deadline', type=float, default=10, help='seconds Telegram waits for an inline answer')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--replay', help='JSON lines of recorded queries to replay')
+    parser.add_argument('--record', help='write the generated queries to this file')
+    add_fake_arguments(parser)
+    args = parser.parse_args()
+
+    if args.replay:
+        events = replay_events(args.replay, args.rate)
+    else:
+        args.rate = args.rate or 50
+        events = synthetic_events(args, random.Random(args.seed))
+    if args.record:
+        record_events(args.record, events)
+    users = max((event.user for event in events), default=0) + 1
+
+    servers = await start_fakes(args)
+    database_url = os.getenv('DATABASE_URL') or f'sqlite+aiosqlite:///{tempfile.mkdtemp()}/bench.db'
+    # The bot reads its configuration at import time
+    os.environ.update(servers.env())
+    os.environ.update(BOT_TOKEN=BOT_TOKEN, DATABASE_URL=database_url)
+    create_users(database_url, users)
+
+    from src import bot as app
+    from src.database.session import close_db, init_db
+
+    try:
+        await init_db()
+        await app.load_identity()
+        await generate(app, events, args, servers)
+    finally:
+        await app.ynison_manager.close()
+        await app.http_pool.close()
+        await close_db()
+        await servers.close()
+        create_users(database_url, 0)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark suite for the now-playing, search and broadcast paths.
+
+Runs the real handlers against the local fakes from benchmarks.fakes, so no
+Telegram bot, Yandex Music token or network access is needed. Latency and error
+rate of every fake can be set from the command line. For each scenario it prints
+p50/p95/p99 latency and throughput:
+
+- now: empty inline queries of users with a token (Ynison, download info, answer)
+- search: inline queries drawn from a small vocabulary, so repeated texts hit the caches
+- broadcast: an @all broadcast to every benchmark user; latency is per message,
+  including the wait for the rate limiter
+
+With --shared-host all fakes answer on one host, so warm Ynison websockets and
+Telegram/Yandex requests compete for the connections the bot allows per host.
+
+Users are created in DATABASE_URL, or in a temporary SQLite database when it is
+not set (needs the aiosqlite driver).
+
+Usage:
+    python -m benchmarks.offline_suite --scenarios now,search,broadcast --queries 500 \\
+        --yandex-latency-ms 40 --telegram-error-rate 0.01
+    python -m benchmarks.offline_suite --scenarios now,search --users 150 --concurrency 150 --shared-host
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from typing import Awaitable, Callable, List
+
+from benchmarks.fakes import FakeServers, FakeTelegram, FakeYandexMusic, FakeYnison
+
+BOT_TOKEN = '123456:benchmark'
+BENCH_USER_ID_BASE = 9_000_000_000_000
+WORDS = ['rock', 'jazz', 'синтвейв', 'lofi', 'metal', 'disco', 'phonk', 'indie', 'techno', 'ambient']
+
+
+def percentile(values: List[float], share: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def report(name: str, latencies: List[float], elapsed: float, errors: int = 0) -> None:
+    latencies = sorted(latencies)
+    print(
+        f'{name:>10}: {len(latencies)} ops in {elapsed:.2f}s, {len(latencies) / elapsed:8.1f} ops/s, '
+        f'p50 {statistics.median(latencies) * 1000:7.1f} ms, '
+        f'p95 {percentile(latencies, 0.95) * 1000:7.1f} ms, '
+        f'p99 {percentile(latencies, 0.99) * 1000:7.1f} ms, errors {errors}'
+    )
+
+
+async def run_concurrently(count: int, concurrency: int, operation: Callable[[int], Awaitable[None]]):
+    """Run operation(0..count-1) with bounded concurrency. Returns latencies, elapsed time and errors."""
+    latencies: List[float] = []
+    errors = 0
+    next_index = 0
+
+    async def worker():
+        nonlocal next_index, errors
+        while next_index < count:
+            index = next_index
+            next_index += 1
+            started = time.perf_counter()
+            try:
+                await operation(index)
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, time.perf_counter() - started, errors
+
+
+def create_users(database_url: str, count: int, with_tokens: bool = True) -> None:
+    """Replace the benchmark users with count fresh ones, holding a token unless with_tokens=False.
+
+    count=0 only removes them.
+    """
+    from sqlalchemy import create_engine, insert
+    from sqlmodel import SQLModel
+    from src.models.user import User
+
+    engine = create_engine(database_url.replace('+aiosqlite', '').replace('+asyncpg', ''))
+    SQLModel.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(User.__table__.delete().where(User.id >= BENCH_USER_ID_BASE))
+        if count:
+            conn.execute(insert(User), [
+                {'id': BENCH_USER_ID_BASE + n, 'ym_token': f'bench-token-{n}' if with_tokens else None}
+                for n in range(count)
+            ])
+    engine.dispose()
+
+
+def inline_query(bot, n: int, users: int, text: str):
+    from aiogram.types import InlineQuery, User
+
+    user = User(id=BENCH_USER_ID_BASE + n % users, is_bot=False, first_name='Bench')
+    return InlineQuery(id=str(n), from_user=user, query=text, offset='').as_(bot)
+
+
+async def bench_now(args) -> None:
+    from src import bot as app
+
+    async def operation(n: int):
+        await app.answer_inline_query(inline_query(app.bot, n, args.users, ''))
+
+    latencies, elapsed, errors = await run_concurrently(args.queries, min(args.concurrency, args.users), operation)
+    report('now', latencies, elapsed, errors)
+
+
+async def bench_search(args) -> None:
+    from src import bot as app
+
+    async def operation(n: int):
+        text = f'{WORDS[n % len(WORDS)]} {n % args.vocabulary}'
+        await app.answer_inline_query(inline_query(app.bot, n, args.users, text))
+
+    latencies, elapsed, errors = await run_concurrently(args.queries, min(args.concurrency, args.users), operation)
+    report('search', latencies, elapsed, errors)
+
+
+async def bench_broadcast(args) -> None:
+    from src import bot as app
+    from src.database.broadcast_operations import create_broadcast
+    from src.services.broadcast import BroadcastEngine
+
+    latencies: List[float] = []
+
+    class TimedBroadcastEngine(BroadcastEngine):
+        async def _send(self, *send_args, **kwargs):
+            started = time.perf_counter()
+            await super()._send(*send_args, **kwargs)
+            latencies.append(time.perf_counter() - started)
+
+    async def no_report(progress):
+        pass
+
+    engine = TimedBroadcastEngine(rate=args.broadcast_rate)
+    broadcast = await create_broadcast('<b>Benchmark</b>', chat_id=1)
+    started = time.perf_counter()
+    progress = await engine.run(app.bot, broadcast, args.users, no_report)
+    report('broadcast', latencies, time.perf_counter() - started, progress.failed)
+
+
+def add_fake_arguments(parser: argparse.ArgumentParser) -> None:
+    for service in ('telegram', 'yandex', 'ynison'):
+        parser.add_argument(f'--{service}-latency-ms', type=float, default=20)
+        parser.add_argument(f'--{service}-jitter-ms', type=float, default=10)
+        parser.add_argument(f'--{service}-error-rate', type=float, default=0)
+    parser.add_argument('--shared-host', action='store_true',
+                        help='serve all fakes from one host, so websockets and REST requests share it')
+
+
+async def start_fakes(args) -> FakeServers:
+    """Start the fakes configured by the add_fake_arguments() options."""
+    def service_args(name):
+        return dict(latency_ms=getattr(args, f'{name}_latency_ms'), jitter_ms=getattr(args, f'{name}_jitter_ms'),
+                    error_rate=getattr(args, f'{name}_error_rate'))
+
+    servers = FakeServers(
+        FakeTelegram(**service_args('telegram')),
+        FakeYandexMusic(**service_args('yandex')),
+        FakeYnison(**service_args('ynison')),
+        shared_host=args.shared_host,
+    )
+    await servers.start()
+    return servers
+
+
+SCENARIOS = {'now': bench_now, 'search': bench_search, 'broadcast': bench_broadcast}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default='now,search,broadcast')
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--vocabulary', type=int, default=50, help='distinct search texts')
+    parser.add_argument('--broadcast-rate', type=float, default=200, help='messages per second')
+    add_fake_arguments(parser)
+    args = parser.parse_args()
+    servers = await start_fakes(args)
+
+    database_url = os.getenv('DATABASE_URL') or f'sqlite+aiosqlite:///{tempfile.mkdtemp()}/bench.db'
+    # The bot reads its configuration at import time
+    os.environ.update(servers.env())
+    os.environ.update(BOT_TOKEN=BOT_TOKEN, DATABASE_URL=database_url, INLINE_DEBOUNCE='0')
+    create_users(database_url, args.users)
+
+    from src import bot as app
+    from src.database.session import close_db, init_db
+
+    try:
+        await init_db()
+        await app.load_identity()
+        for name in args.scenarios.split(','):
+            await SCENARIOS[name](args)
+        print(f'upstream requests: telegram {servers.telegram.requests}, yandex {servers.yandex.requests}, '
+              f'ynison {servers.ynison.requests}')
+    finally:
+        await app.ynison_manager.close()
+        await app.http_pool.close()
+        await close_db()
+        await servers.close()
+        create_users(database_url, 0)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Latency benchmark of download-info resolution for a page of search results.
+
+Uses stand-in tracks whose get_specific_download_info_async and
+get_direct_link_async sleep for a random upstream latency, so no Yandex
+Music token is needed. Compares resolving the page one track after another
+(the old inline_search loop) with src.services.audio.resolve_direct_links.
+
+Usage:
+    python -m benchmarks.resolve_latency --queries 50 --tracks 6 --latency-ms 80
+"""
+
+import argparse
+import asyncio
+import random
+import statistics
+import time
+from typing import List, Optional
+
+from src.services.audio import link_cache, missing_bitrates, resolve_direct_link, resolve_direct_links
+
+
+class FakeDownloadInfo:
+    def __init__(self, track: 'FakeTrack', bitrate: int):
+        self.track = track
+        self.bitrate_in_kbps = bitrate
+        self.direct_link = None
+
+    async def get_direct_link_async(self) -> str:
+        await self.track.upstream()
+        return f'https://example.invalid/{self.track.id}/{self.bitrate_in_kbps}.mp3'
+
+
+class FakeTrack:
+    def __init__(self, track_id: int, latency_ms: float, jitter_ms: float, slow_ratio: float, has_320: bool):
+        self.id = track_id
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.slow_ratio = slow_ratio
+        self.bitrates = (320, 192) if has_320 else (192,)
+        self.download_info = None
+
+    async def upstream(self):
+        latency = self.latency_ms + random.uniform(0, self.jitter_ms)
+        if random.random() < self.slow_ratio:
+            latency *= 20
+        await asyncio.sleep(latency / 1000)
+
+    async def get_specific_download_info_async(self, codec: str, bitrate_in_kbps: int) -> Optional[FakeDownloadInfo]:
+        if self.download_info is None:
+            await self.upstream()
+            self.download_info = [FakeDownloadInfo(self, bitrate) for bitrate in self.bitrates]
+        for info in self.download_info:
+            if info.bitrate_in_kbps == bitrate_in_kbps:
+                return info
+        return None
+
+
+async def sequential(tracks) -> List[Optional[str]]:
+    return [await resolve_direct_link(track) for track in tracks]
+
+
+async def measure(resolver, args) -> List[float]:
+    # Both modes start cold, otherwise the second one is answered from the link cache
+    link_cache.clear()
+    missing_bitrates.clear()
+    latencies = []
+    for i in range(args.queries):
+        tracks = [
+            FakeTrack(i * args.tracks + n, args.latency_ms, args.jitter_ms, args.slow_ratio, random.random() > 0.3)
+            for n in range(args.tracks)
+        ]
+        started = time.perf_counter()
+        await resolver(tracks)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+
+def report(name: str, latencies: List[float]) -> None:
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{name:>10}: p50 {statistics.median(latencies):7.1f} ms, p95 {p95:7.1f} ms, max {latencies[-1]:7.1f} ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--tracks', type=int, default=6)
+    parser.add_argument('--latency-ms', type=float, default=80.0)
+    parser.add_argument('--jitter-ms', type=float, default=40.0)
+    parser.add_argument('--slow-ratio', type=float, default=0.02, help='share of upstream calls that are 20x slower')
+    args = parser.parse_args()
+
+    random.seed(0)
+    report('sequential', await measure(sequential, args))
+    random.seed(0)
+    report('concurrent', await measure(resolve_direct_links, args))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Load test of webhook mode: updates per second by number of worker processes.
+
+Starts a fake Telegram Bot API server, runs the bot with BOT_MODE=webhook and
+TELEGRAM_API_URL pointing at the fake, and posts inline query updates to the
+webhook. Every update comes from a different user without a Yandex Music token,
+so each one is answered with the "connect your token" article and no Yandex
+call is made. Throughput is the number of answerInlineQuery calls the fake
+server received per second.
+
+Users are created up front in DATABASE_URL, or in a temporary SQLite database
+when it is not set (needs the aiosqlite driver).
+
+Usage:
+    python -m benchmarks.webhook_throughput --updates 5000 --workers 1,2,4
+"""
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict
+
+import aiohttp
+from aiohttp import web
+
+from benchmarks.fakes import FakeTelegram, free_port
+from benchmarks.offline_suite import BENCH_USER_ID_BASE, BOT_TOKEN, create_users
+
+
+def make_update(n: int) -> Dict:
+    user = {'id': BENCH_USER_ID_BASE + n, 'is_bot': False, 'first_name': f'user{n}'}
+    return {
+        'update_id': n + 1,
+        'inline_query': {'id': str(n), 'from': user, 'query': '', 'offset': ''},
+    }
+
+
+async def run_load(workers: int, args, database_url: str) -> float:
+    telegram = FakeTelegram()
+    telegram_port, webhook_port = free_port(), free_port()
+    app = web.Application()
+    telegram.setup(app)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', telegram_port).start()
+
+    env = dict(
+        os.environ,
+        BOT_TOKEN=BOT_TOKEN,
+        BOT_MODE='webhook',
+        WEBHOOK_WORKERS=str(workers),
+        WEBHOOK_HOST='127.0.0.1',
+        WEBHOOK_PORT=str(webhook_port),
+        WEBHOOK_URL=f'http://127.0.0.1:{webhook_port}',
+        TELEGRAM_API_URL=f'http://127.0.0.1:{telegram_port}',
+        DATABASE_URL=database_url,
+        INLINE_DEBOUNCE='0',
+    )
+    bot = subprocess.Popen([sys.executable, '-m', 'src.bot'], env=env,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL if not args.verbose else None)
+    try:
+        await asyncio.wait_for(telegram.webhook_set.wait(), timeout=60)
+        url = f'http://127.0.0.1:{webhook_port}/webhook'
+        async with aiohttp.ClientSession() as session:
+            # Wait until the webhook accepts connections
+            for _ in range(100):
+                try:
+                    async with session.get(url):
+                        break
+                except aiohttp.ClientConnectionError:
+                    await asyncio.sleep(0.1)
+
+            queue: asyncio.Queue = asyncio.Queue()
+            for n in range(args.updates):
+                queue.put_nowait(make_update(n))
+
+            async def sender():
+                while not queue.empty():
+                    update = queue.get_nowait()
+                    async with session.post(url, json=update) as resp:
+                        await resp.read()
+
+            started = time.perf_counter()
+            await asyncio.gather(*(sender() for _ in range(args.concurrency)))
+            await asyncio.wait_for(telegram.wait_for('answerInlineQuery', args.updates), timeout=120)
+            return args.updates / (time.perf_counter() - started)
+    finally:
+        bot.terminate()
+        bot.wait(timeout=60)
+        await runner.cleanup()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=100, help='parallel webhook requests, like max_connections')
+    parser.add_argument('--workers', default='1,2,4', help='comma-separated worker counts to compare')
+    parser.add_argument('--verbose', action='store_true', help="show the bot's log output")
+    args = parser.parse_args()
+
+    database_url = os.getenv('DATABASE_URL')
+    if not database_url:
+        database_url = f'sqlite+aiosqlite:///{tempfile.mkdtemp()}/bench.db'
+    create_users(database_url, args.updates, with_tokens=False)
+
+    print(f'{os.cpu_count()} CPUs')
+    try:
+        for workers in (int(value) for value in args.workers.split(',')):
+            rate = await run_load(workers, args, database_url)
+            print(f'{workers:>2} workers: {rate:8.1f} updates/s')
+    finally:
+        create_users(database_url, 0)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -3,13 +3,14 @@ import hashlib
 import re
 import os
 import random
-import json
-import string
 import html
-from typing import Optional, Dict, Any
-from datetime import datetime, timedelta
+import signal
+import time
+from typing import Optional, Dict, Any, List, Tuple
 
+from aiohttp import web
 from aiogram import Bot, Dispatcher, F
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
 from aiogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
@@ -17,256 +18,448 @@ from aiogram.types import (
     InlineQuery,
     InlineQueryResultArticle,
     InlineQueryResultAudio,
+    InlineQueryResultCachedAudio,
     InputTextMessageContent,
     SwitchInlineQueryChosenChat,
-    BufferedInputFile
+    ChosenInlineResult,
+    User as TelegramUser
 )
 from aiogram.filters import Command, CommandStart
-from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter, TelegramAPIError
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from yandex_music import ClientAsync
-from yandex_music.exceptions import YandexMusicError
+from yandex_music.exceptions import YandexMusicError, UnauthorizedError
 
 from dotenv import load_dotenv
-import aiohttp
 
-from loguru import logger
 
 # Import new database operations
-from .database.user_operations import handle_user, update_user, get_user
-from .database.statistics_operations import update_statistics, get_latest_statistics
+from .database.user_operations import handle_user, update_user, get_user, user_cache
+from .database.statistics_operations import update_statistics
+from .database.track_file_operations import file_id_cache, get_file_ids
+from .database.broadcast_operations import create_broadcast, get_unfinished_broadcast
+from .models.broadcast import Broadcast
 from .models.user import User as UserModel
+from .services.admission import (
+    INLINE_DEGRADED_CACHE_TIME, ArrivalTimeMiddleware, QueryExpired, inline_admission,
+)
+from .services.audio import (
+    cached_direct_link, resolve_direct_link, resolve_direct_links, link_cache, missing_bitrates, hot_links,
+)
+from .services.audio_redirect import audio_redirects
+from .services.broadcast import BroadcastProgress, broadcast_engine
+from .services.http import http_pool, SharedAiohttpSession
+from .services.inline_queries import inline_tracker
+from .services.metrics import METRICS_PORT, Gauge, inline_queries_total, inline_stage_seconds, serve_metrics
+from .services.now_playing import NowPlaying, now_playing_cache
+from .services.ordering import UserOrderingMiddleware
+from .services.popularity import popularity
+from .services.search import SEARCH_PAGE_SIZE, normalize_query, search_cache, search_tracks
+from .services.uploads import audio_uploader
+from .services.yandex_clients import client_pool
+from .services.ynison import ynison_manager
+from .webhook import WEBHOOK_WORKERS, run_workers, serve_dispatcher, set_webhook
 
 load_dotenv()
 
-bot = Bot(os.getenv('BOT_TOKEN'))
+# "polling" or "webhook", see src/webhook.py
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Base URL of the Bot API server, e.g. a local telegram-bot-api instance
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+
+api = TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else PRODUCTION
+bot = Bot(os.getenv('BOT_TOKEN'), session=SharedAiohttpSession(api=api))
 dp = Dispatcher()
+# Registered first, so the deadline of an inline query counts from its arrival
+dp.update.outer_middleware(ArrivalTimeMiddleware())
+# Keep each user's messages in order, and ahead of their later inline queries
+dp.update.outer_middleware(UserOrderingMiddleware())
+
+# The bot's own account and the markup built from it, resolved once by load_identity() in main()
+me: Optional[TelegramUser] = None
+bot_button: Optional[InlineKeyboardButton] = None
+
+
+def chosen_chat_markup(text: str) -> InlineKeyboardMarkup:
+    button = InlineKeyboardButton(
+        text=text,
+        switch_inline_query_chosen_chat=SwitchInlineQueryChosenChat(
+            query='',
+            allow_user_chats=True,
+            allow_bot_chats=True,
+            allow_group_chats=True,
+            allow_channel_chats=True)
+    )
+    return InlineKeyboardMarkup(inline_keyboard=[[button]])
+
 
+new_user_markup = chosen_chat_markup('Или нажми на эту кнопку и выбери чат :)')
+ready_markup = chosen_chat_markup('Либо нажмите на эту кнопку и выберите чат :)')
 
-async def get_audio_url(audio: bytes):
+
+async def load_identity() -> None:
+    global me, bot_button
     me = await bot.get_me()
-    msg = await bot.send_audio(
-        chat_id=me.id,
-        audio=BufferedInputFile(audio, filename=f'{random.randint(10000, 99999)}.mp3')
+    bot_button = InlineKeyboardButton(text=f'@{me.username}', url=f'https://t.me/{me.username}')
+
+
+def track_markup(track_id: str) -> InlineKeyboardMarkup:
+    song_button = InlineKeyboardButton(text='Ссылка на трек', url=f'https://song.link/ya/{track_id}')
+    return InlineKeyboardMarkup(inline_keyboard=[[song_button], [bot_button]])
+
+
+def make_result_id(kind: str, track_id: str) -> str:
+    """Inline result id that carries the track id, so chosen results can be matched to tracks."""
+    return f'{kind}:{track_id}:{random.randint(1000, 9999)}'
+
+
+def parse_result_id(result_id: str) -> Optional[Tuple[str, str]]:
+    """Kind and track id of a result id made by make_result_id()."""
+    parts = result_id.split(':')
+    if len(parts) < 3:
+        return None
+    return parts[0], ':'.join(parts[1:-1])
+
+
+def audio_result(result_id: str, track_id: str, file_id: Optional[str], url: Optional[str],
+                 title: str, artists: str, duration: int, caption: str, markup: InlineKeyboardMarkup):
+    """Audio already uploaded to Telegram is sent by file_id, anything else by its direct link."""
+    if file_id:
+        return InlineQueryResultCachedAudio(
+            id=result_id,
+            audio_file_id=file_id,
+            parse_mode='html',
+            reply_markup=markup,
+            caption=caption
+        )
+    audio_uploader.served(track_id, url, title, artists, duration)
+    return InlineQueryResultAudio(
+        id=result_id,
+        title=title,
+        parse_mode='html',
+        audio_duration=duration,
+        reply_markup=markup,
+        audio_url=url,
+        caption=caption,
+        performer=artists
     )
-    if msg.audio and msg.audio.file_id:
-        file = await bot.get_file(msg.audio.file_id)
-        if file and file.file_path:
-            return f'https://api.telegram.org/file/bot{bot.token}/{file.file_path}'
-    return None
 
 
 # https://github.com/vsecoder/hikka_modules/blob/main/ymnow.py#L42
 async def get_current_track(client: ClientAsync, token: str):
-    device_info = {
-        "app_name": "Chrome",
-        "type": 1,
-    }
-
-    ws_proto = {
-        "Ynison-Device-Id": "".join(
-            [random.choice(string.ascii_lowercase) for _ in range(16)]
-        ),
-        "Ynison-Device-Info": json.dumps(device_info),
-    }
-
-    timeout = aiohttp.ClientTimeout(total=15, connect=10)
     try:
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.ws_connect(
-                url="wss://ynison.music.yandex.ru/redirector.YnisonRedirectService/GetRedirectToYnison",
-                headers={
-                    "Sec-WebSocket-Protocol": f"Bearer, v2, {json.dumps(ws_proto)}",
-                    "Origin": "http://music.yandex.ru",
-                    "Authorization": f"OAuth {token}",
-                },
-            ) as ws:
-                recv = await ws.receive()
-                data = json.loads(recv.data)
-
-            if "redirect_ticket" not in data or "host" not in data:
-                print(f"Invalid response structure: {data}")
-                return {"success": False}
-
-            new_ws_proto = ws_proto.copy()
-            new_ws_proto["Ynison-Redirect-Ticket"] = data["redirect_ticket"]
-
-            to_send = {
-                "update_full_state": {
-                    "player_state": {
-                        "player_queue": {
-                            "current_playable_index": -1,
-                            "entity_id": "",
-                            "entity_type": "VARIOUS",
-                            "playable_list": [],
-                            "options": {"repeat_mode": "NONE"},
-                            "entity_context": "BASED_ON_ENTITY_BY_DEFAULT",
-                            "version": {
-                                "device_id": ws_proto["Ynison-Device-Id"],
-                                "version": 9021243204784341000,
-                                "timestamp_ms": 0,
-                            },
-                            "from_optional": "",
-                        },
-                        "status": {
-                            "duration_ms": 0,
-                            "paused": True,
-                            "playback_speed": 1,
-                            "progress_ms": 0,
-                            "version": {
-                                "device_id": ws_proto["Ynison-Device-Id"],
-                                "version": 8321822175199937000,
-                                "timestamp_ms": 0,
-                            },
-                        },
-                    },
-                    "device": {
-                        "capabilities": {
-                            "can_be_player": True,
-                            "can_be_remote_controller": False,
-                            "volume_granularity": 16,
-                        },
-                        "info": {
-                            "device_id": ws_proto["Ynison-Device-Id"],
-                            "type": "WEB",
-                            "title": "Chrome Browser",
-                            "app_name": "Chrome",
-                        },
-                        "volume_info": {"volume": 0},
-                        "is_shadow": True,
-                    },
-                    "is_currently_active": False,
-                },
-                "rid": "ac281c26-a047-4419-ad00-e4fbfda1cba3",
-                "player_action_timestamp_ms": 0,
-                "activity_interception_type": "DO_NOT_INTERCEPT_BY_DEFAULT",
-            }
-
-            async with session.ws_connect(
-                url=f"wss://{data['host']}/ynison_state.YnisonStateService/PutYnisonState",
-                headers={
-                    "Sec-WebSocket-Protocol": f"Bearer, v2, {json.dumps(new_ws_proto)}",
-                    "Origin": "http://music.yandex.ru",
-                    "Authorization": f"OAuth {token}",
-                },
-                method="GET",
-            ) as ws:
-                await ws.send_str(json.dumps(to_send))
-                recv = await asyncio.wait_for(ws.receive(), timeout=10)
-                ynison = json.loads(recv.data)
-                track_index = ynison["player_state"]["player_queue"][
-                    "current_playable_index"
-                ]
-                if track_index == -1:
-                    print("No track is currently playing.")
-                    return {"success": False}
-                track = ynison["player_state"]["player_queue"]["playable_list"][
-                    track_index
-                ]
-
-            await session.close()
-            info = await client.tracks_download_info(track["playable_id"], True)
-            track = await client.tracks(track["playable_id"])
-            return {
-                "paused": ynison["player_state"]["status"]["paused"],
-                "duration_ms": ynison["player_state"]["status"]["duration_ms"],
-                "progress_ms": ynison["player_state"]["status"]["progress_ms"],
-                "entity_id": ynison["player_state"]["player_queue"]["entity_id"],
-                "repeat_mode": ynison["player_state"]["player_queue"]["options"][
-                    "repeat_mode"
-                ],
-                "entity_type": ynison["player_state"]["player_queue"]["entity_type"],
-                "track": track,
-                "info": info,
-                "success": True,
-            }
+        with inline_stage_seconds.time(stage='ynison'):
+            ynison, received_at = await ynison_manager.get_state(token)
+        track_index = ynison["player_state"]["player_queue"][
+            "current_playable_index"
+        ]
+        if track_index == -1:
+            print("No track is currently playing.")
+            return {"success": False}
+        track = ynison["player_state"]["player_queue"]["playable_list"][
+            track_index
+        ]
+
+        status = ynison["player_state"]["status"]
+        progress_ms = status["progress_ms"]
+        if not status["paused"]:
+            # The state may have been pushed a while ago, account for the time since
+            progress_ms += int((time.monotonic() - received_at) * 1000)
+            if status["duration_ms"]:
+                progress_ms = min(progress_ms, status["duration_ms"])
+
+        playable_id = str(track["playable_id"])
+        with inline_stage_seconds.time(stage='track_info'):
+            # Behind the redirect endpoint links are resolved only when Telegram fetches them
+            info = None if audio_redirects.enabled else await client.tracks_download_info(playable_id, True)
+            track = await client.tracks(playable_id)
+        if track and info:
+            # Reuse the resolved links instead of requesting download info again
+            track[0].download_info = info
+        return {
+            "paused": status["paused"],
+            "duration_ms": status["duration_ms"],
+            "progress_ms": progress_ms,
+            "entity_id": ynison["player_state"]["player_queue"]["entity_id"],
+            "repeat_mode": ynison["player_state"]["player_queue"]["options"][
+                "repeat_mode"
+            ],
+            "entity_type": ynison["player_state"]["player_queue"]["entity_type"],
+            "playable_id": playable_id,
+            "track": track,
+            "info": info,
+            "success": True,
+        }
 
     except Exception as e:
+        if isinstance(e, UnauthorizedError):
+            # The token has been revoked, don't keep its client around
+            client_pool.invalidate(token)
+            await ynison_manager.invalidate(token)
+            now_playing_cache.forget(token)
         return {"success": False, "error": str(e), "track": None}
 
 
-@dp.message(F.text.startswith('@all') & F.from_user.id == int(os.getenv('ADMIN_ID', '0')))
+async def compute_now_playing(token: str) -> Tuple[Optional[NowPlaying], str]:
+    """The current track of the token's user with its file_id or direct link.
+
+    Returns the result, or None and the outcome explaining why there is none.
+    """
+    with inline_stage_seconds.time(stage='client'):
+        client = await client_pool.get(token)
+    res = await get_current_track(client, token)
+    if not res['success']:
+        return None, 'error' if res.get('error') else 'no_track'
+    if not res.get('track'):
+        return None, 'no_track'
+
+    track = res['track'][0]
+    track_id = str(track.id or "")
+    with inline_stage_seconds.time(stage='resolve'):
+        file_id = (await get_file_ids([track_id])).get(track_id)
+        # With the redirect endpoint the answer links to it instead
+        url = None if file_id or audio_redirects.enabled else await resolve_direct_link(track)
+    if file_id is None and url is None and not audio_redirects.enabled:
+        return None, 'no_link'
+    return NowPlaying(
+        track=track,
+        playable_id=res['playable_id'],
+        file_id=file_id,
+        url=url,
+        paused=res['paused'],
+        duration_ms=res['duration_ms'],
+        progress_ms=res['progress_ms'],
+        computed_at=time.monotonic(),
+    ), 'success'
+
+
+async def prefetch_now_playing(token: str) -> Optional[NowPlaying]:
+    return (await compute_now_playing(token))[0]
+
+
+def broadcast_status(progress: BroadcastProgress) -> str:
+    title = 'Broadcast completed' if progress.done else 'Broadcasting...'
+    return (
+        f"{title}\n"
+        f"✅ Successful: {progress.sent}\n"
+        f"🚫 Blocked: {progress.blocked}\n"
+        f"❌ Failed: {progress.failed}\n"
+        f"📊 Processed: {progress.processed}/{progress.total}\n"
+        f"⚡ {progress.throughput:.1f} msg/s (limit {progress.rate_limit:.1f}), retries {progress.retries}"
+    )
+
+
+async def start_broadcast(broadcast: Broadcast) -> None:
+    """Run a new or interrupted broadcast, reporting progress to the chat that started it."""
+    from src.database.statistics_operations import get_user_count
+
+    total = await get_user_count()
+    status = await bot.send_message(broadcast.chat_id, f"Sending broadcast message to {total} users...")
+
+    async def report(progress: BroadcastProgress):
+        try:
+            await status.edit_text(broadcast_status(progress))
+        except TelegramBadRequest:
+            # Nothing has changed since the last report
+            pass
+
+    broadcast_engine.start(bot, broadcast, total, report)
+
+
+@dp.message(F.text.startswith('@all'), F.from_user.id == int(os.getenv('ADMIN_ID', '0')))
 async def mail(message: Message):
     text = message.html_text[4:] if message.html_text else ""
     if not text:
         await message.answer("Please provide a message to broadcast.")
         return
-    
-    # Get all users from database
-    from src.database.user_operations import get_all_users
-    users = await get_all_users()
-    
-    if not users:
-        await message.answer("No users found to broadcast to.")
+
+    if broadcast_engine.running:
+        await message.answer("Another broadcast is still running.")
         return
-    
-    # Send confirmation to admin
-    await message.answer(f"Sending broadcast message to {len(users)} users...")
-    
-    # Send message to all users
-    success_count = 0
-    fail_count = 0
-    
-    for user in users:
-        try:
-            await bot.send_message(user.id, text, parse_mode='HTML')
-            success_count += 1
-            # Add a small delay to avoid hitting rate limits
-            await asyncio.sleep(0.05)
-        except TelegramRetryAfter as e:
-            # Handle rate limiting
-            await asyncio.sleep(e.retry_after)
-            try:
-                await bot.send_message(user.id, text, parse_mode='HTML')
-                success_count += 1
-            except Exception:
-                fail_count += 1
-        except TelegramAPIError:
-            fail_count += 1
-        except Exception:
-            fail_count += 1
-    
-    # Send summary to admin
-    await message.answer(
-        f"Broadcast completed:\n"
-        f"✅ Successful: {success_count}\n"
-        f"❌ Failed: {fail_count}\n"
-        f"📊 Total: {len(users)}"
-    )
-    
+
+    broadcast = await create_broadcast(text, message.chat.id)
+    await start_broadcast(broadcast)
+
 
 @dp.message(Command('stats'))
 async def stats_command(message: Message):
     """Show statistics to the user."""
-    from src.database.statistics_operations import get_user_count
-    
-    stats = await get_latest_statistics()
-    # Get actual user count from database
-    user_count = await get_user_count()
-    
-    if not stats:
+    from src.database.statistics_operations import statistics_snapshotter
+
+    stats = statistics_snapshotter.current()
+
+    if not stats.refreshed_at:
         await message.answer("Статистика пока недоступна.")
         return
-    
-    total_requests = stats.total_requests
-    successful_requests = stats.successful_requests
-    daily_requests = stats.daily_requests
-    
+
     await message.answer(
         f"<b>📊 Статистика бота</b>\n\n"
-        f"👥 Пользователей: {user_count}\n"
-        f"📈 Всего запросов: {total_requests}\n"
-        f"✅ Успешных запросов: {successful_requests}\n"
-        f"📅 Запросов сегодня: {daily_requests}\n\n"
+        f"👥 Пользователей: {stats.users}\n"
+        f"📈 Всего запросов: {stats.total_requests}\n"
+        f"✅ Успешных запросов: {stats.successful_requests}\n"
+        f"📅 Запросов сегодня: {stats.daily_requests}\n\n"
         f"<i>Статистика обновляется автоматически</i>",
         parse_mode='html'
     )
 
 
+def cache_stats() -> Dict[str, Dict[str, Any]]:
+    return {
+        'users': user_cache.stats(),
+        'yandex clients': client_pool.stats(),
+        'search': search_cache.stats(),
+        'direct links': link_cache.stats(),
+        'telegram files': file_id_cache.stats(),
+        'missing bitrates': missing_bitrates.stats(),
+    }
+
+
+def _cache_gauge(field: str):
+    return lambda: {(name,): stats[field] for name, stats in cache_stats().items()}
+
+
+Gauge('ymbot_cache_entries', 'Entries in in-process caches', _cache_gauge('size'), ['cache'])
+Gauge('ymbot_cache_hits', 'Cache hits since start', _cache_gauge('hits'), ['cache'])
+Gauge('ymbot_cache_misses', 'Cache misses since start', _cache_gauge('misses'), ['cache'])
+Gauge('ymbot_cache_evictions', 'Cache evictions since start', _cache_gauge('evictions'), ['cache'])
+Gauge('ymbot_http_connections', 'Connections of the shared HTTP pool',
+      lambda: {('in_use',): http_pool.stats()['in_use'], ('idle',): http_pool.stats()['idle']}, ['state'])
+Gauge('ymbot_ynison_sessions', 'Ynison sessions kept by the bot',
+      lambda: {('total',): ynison_manager.stats()['sessions'], ('connected',): ynison_manager.stats()['connected']}, ['state'])
+Gauge('ymbot_inline_queries_in_flight', 'Inline queries being answered',
+      lambda: {(): inline_tracker.stats()['in_flight']})
+Gauge('ymbot_inline_admission', 'Inline queries holding or waiting for an admission slot',
+      lambda: {('running',): inline_admission.stats()['running'],
+               ('waiting',): inline_admission.stats()['waiting']}, ['state'])
+Gauge('ymbot_now_playing_users', 'Recently active users and their cached now-playing results',
+      lambda: {('active',): now_playing_cache.stats()['active'],
+               ('cached',): now_playing_cache.stats()['results']}, ['state'])
+Gauge('ymbot_upload_queue', 'Tracks waiting to be uploaded to the storage chat',
+      lambda: {(): audio_uploader.stats()['queued']})
+
+
+@dp.message(Command('cache'), F.from_user.id == int(os.getenv('ADMIN_ID', '0')))
+async def cache_command(message: Message):
+    """Show in-process cache counters to the admin."""
+    caches = cache_stats()
+    ynison_stats = ynison_manager.stats()
+    http_stats = http_pool.stats()
+    upload_stats = audio_uploader.stats()
+    redirect_stats = audio_redirects.stats()
+    popularity_stats = popularity.stats()
+    query_stats = inline_tracker.stats()
+    admission_stats = inline_admission.stats()
+    now_playing_stats = now_playing_cache.stats()
+    lines = ['<b>🗄 Кэши</b>\n']
+    for name, stats in caches.items():
+        lines.append(
+            f'<b>{name}</b>: {stats["size"]}/{stats["maxsize"]}, '
+            f'hits {stats["hits"]}, misses {stats["misses"]}, '
+            f'evictions {stats["evictions"]}, hit rate {stats["hit_rate"]:.1%}'
+        )
+    lines.append(
+        f'<b>ynison</b>: {ynison_stats["connected"]}/{ynison_stats["sessions"]} connected, '
+        f'warm hits {ynison_stats["warm_hits"]}, connects {ynison_stats["connects"]}, '
+        f'redirects {ynison_stats["redirects"]}'
+    )
+    lines.append(
+        f'<b>http</b>: {http_stats["in_use"]} in use, {http_stats["idle"]} idle, '
+        f'limit {http_stats["limit"]} ({http_stats["limit_per_host"]} per host)'
+    )
+    lines.append(
+        f'<b>inline queries</b>: {query_stats["queries"]}, in flight {query_stats["in_flight"]}, '
+        f'superseded {query_stats["superseded"]}, searches saved {query_stats["searches_saved"]}'
+    )
+    lines.append(
+        f'<b>admission</b>: {admission_stats["running"]} running, {admission_stats["waiting"]} waiting, '
+        f'admitted {admission_stats["admitted"]} ({admission_stats["waited"]} after waiting), '
+        f'degraded {admission_stats["degraded"]}, expired {admission_stats["expired"]}'
+    )
+    lines.append(
+        f'<b>now playing</b>: {now_playing_stats["results"]}/{now_playing_stats["active"]} cached, '
+        f'prefetch {"on" if now_playing_stats["prefetch"] else "off"}, hits {now_playing_stats["hits"]}, '
+        f'misses {now_playing_stats["misses"]}, revalidations {now_playing_stats["revalidations"]}, '
+        f'refreshes {now_playing_stats["refreshes"]}, failures {now_playing_stats["failures"]}'
+    )
+    lines.append(
+        f'<b>uploads</b>: {"on" if upload_stats["enabled"] else "off"}, queued {upload_stats["queued"]}, '
+        f'uploaded {upload_stats["uploaded"]}, failed {upload_stats["failed"]}'
+    )
+    lines.append(
+        f'<b>chosen results</b>: {popularity_stats["chosen"]}, top {popularity_stats["tracks"]} tracks '
+        f'and {popularity_stats["queries"]} queries, warmed searches {popularity_stats["warmed_searches"]}, '
+        f'links {popularity_stats["warmed_links"]}, queued uploads {popularity_stats["queued_uploads"]}'
+    )
+    lines.append(
+        f'<b>audio redirects</b>: {"on" if redirect_stats["enabled"] else "off"}, '
+        f'redirects {redirect_stats["redirects"]}'
+    )
+    await message.answer('\n'.join(lines), parse_mode='html')
+
+
 @dp.inline_query()
-async def inline_search(query: InlineQuery):
-    usr_data = await handle_user(query.from_user.id)
+async def inline_search(query: InlineQuery, arrived_at: Optional[float] = None):
+    # A newer query from the same user cancels this one
+    inline_tracker.start(query.from_user.id)
+    kind = 'now' if query.query.strip() == '' else 'search'
+    try:
+        with inline_stage_seconds.time(stage='total'):
+            # Under overload the query is answered from caches, and dropped once Telegram stopped waiting
+            async with inline_admission.admit(query.from_user.id, arrived_at) as full:
+                outcome = await answer_inline_query(query, cache_only=not full)
+    except QueryExpired:
+        inline_queries_total.inc(kind=kind, outcome='expired')
+    except asyncio.CancelledError:
+        inline_queries_total.inc(kind=kind, outcome='superseded')
+        raise
+    except Exception:
+        inline_queries_total.inc(kind=kind, outcome='error')
+        raise
+    else:
+        inline_queries_total.inc(kind=kind, outcome=outcome)
+    finally:
+        inline_tracker.finish(query.from_user.id)
+
+
+async def answer(query: InlineQuery, **kwargs) -> None:
+    with inline_stage_seconds.time(stage='answer'):
+        await query.answer(**kwargs)
+
+
+async def answer_busy(query: InlineQuery) -> str:
+    """Answer a query that can't be served from caches while the bot is overloaded."""
+    text = 'Бот сейчас перегружен. Попробуйте ещё раз через несколько секунд.'
+    content = InputTextMessageContent(message_text=text, parse_mode='html')
+    result_id = hashlib.md5(f'busy:{random.randint(0, 99999999)}'.encode()).hexdigest()
+    result = InlineQueryResultArticle(
+        id=result_id,
+        title='Слишком много запросов, попробуйте позже',
+        input_message_content=content
+    )
+    await answer(
+        query,
+        results=[result],
+        cache_time=INLINE_DEGRADED_CACHE_TIME,
+        is_personal=True
+    )
+    return 'busy'
+
+
+async def answer_inline_query(query: InlineQuery, cache_only: bool = False) -> str:
+    """Answer the query and return its outcome for metrics.
+
+    With cache_only nothing goes upstream, not even the database: the user and the
+    results come from in-process caches, or a "busy" article is answered. Busy
+    answers are not counted in the statistics.
+    """
+    if cache_only:
+        usr_data = user_cache.get(query.from_user.id)
+        if usr_data is None:
+            return await answer_busy(query)
+    else:
+        with inline_stage_seconds.time(stage='handle_user'):
+            usr_data = await handle_user(query.from_user.id)
     # Convert user data to dict for compatibility
     usr: Dict[str, Any] = {
         'id': usr_data.id,
@@ -274,8 +467,6 @@ async def inline_search(query: InlineQuery):
         'ym_token': usr_data.ym_token
     }
 
-    me = await bot.get_me()
-
     if not usr.get('ym_token'):
         text = f'Для работы бота нужен твой токен Яндекс Музыки. ' \
             f'Пожалуйста, открой бота @{me.username} ' \
@@ -288,57 +479,28 @@ async def inline_search(query: InlineQuery):
             title='Нажми чтобы подключить токен Яндекс Музыки',
             input_message_content=content
         )
-        return await query.answer(
+        await answer(
+            query,
             results=[result],
             cache_time=20,
             is_personal=True
         )
+        return 'no_token'
     
     if query.query.strip() == '':
         
-        # Update statistics for total requests
-        await update_statistics(total_requests=1, daily_requests=1)
-        
         if not usr.get('ym_token'):
-            return
-        
-        client = await ClientAsync(token=usr['ym_token']).init()
-        res = await get_current_track(client, usr['ym_token'])
-        if not res['success']:
-            text = 'Не удалось найти играющий трек. Попробуйте позже.'
-            content = InputTextMessageContent(message_text=text, parse_mode='html')
-            result_id = hashlib.md5(f'now-error:{random.randint(0, 99999999)}'.encode()).hexdigest()
-            result = InlineQueryResultArticle(
-                id=result_id,
-                title='Ничего не найдено',
-                input_message_content=content
-            )
-            return await query.answer(
-                results=[result],
-                cache_time=20,
-                is_personal=True
-            )
+            return 'no_token'
         
-        if not res.get('track') or not res['track']:
-            text = 'Не удалось найти играющий трек. Попробуйте позже.'
-            content = InputTextMessageContent(message_text=text, parse_mode='html')
-            result_id = hashlib.md5(f'now-error:{random.randint(0, 99999999)}'.encode()).hexdigest()
-            result = InlineQueryResultArticle(
-                id=result_id,
-                title='Ничего не найдено',
-                input_message_content=content
-            )
-            return await query.answer(
-                results=[result],
-                cache_time=15,
-                is_personal=True
-            )
-            
-        track = res['track'][0]
-        dlinfo = await track.get_specific_download_info_async(codec='mp3', bitrate_in_kbps=320)
-        if dlinfo is None:
-            dlinfo = await track.get_specific_download_info_async(codec='mp3', bitrate_in_kbps=192)
-            if dlinfo is None:
+        now_playing = now_playing_cache.get(usr['ym_token'])
+        if now_playing is None and cache_only:
+            return await answer_busy(query)
+
+        # Update statistics for total requests
+        await update_statistics(total_requests=1, daily_requests=1)
+        if now_playing is None:
+            now_playing, outcome = await compute_now_playing(usr['ym_token'])
+            if now_playing is None:
                 text = 'Не удалось найти играющий трек. Попробуйте позже.'
                 content = InputTextMessageContent(message_text=text, parse_mode='html')
                 result_id = hashlib.md5(f'now-error:{random.randint(0, 99999999)}'.encode()).hexdigest()
@@ -347,97 +509,137 @@ async def inline_search(query: InlineQuery):
                     title='Ничего не найдено',
                     input_message_content=content
                 )
-                return await query.answer(
+                await answer(
+                    query,
                     results=[result],
-                    cache_time=15,
+                    cache_time=20 if outcome == 'error' else 15,
                     is_personal=True
                 )
-        url = await dlinfo.get_direct_link_async()
+                return outcome
+            now_playing_cache.put(usr['ym_token'], now_playing)
+
+        track = now_playing.track
+        track_id = str(track.id or "")
+        file_id, url = now_playing.file_id, now_playing.url
+        if file_id is None and url is None:
+            url = audio_redirects.url(track_id, query.from_user.id)
         title = track.title or "Неизвестный трек"
         artists = ', '.join([artist.name for artist in track.artists]) if track.artists else "Неизвестный исполнитель"
         duration = (track.duration_ms or 0) // 1000
-        logger.info(res.get('progress_ms', 0))
-        track_id = track.id or ""
-        result_id = hashlib.md5(f'now:{track_id}:{random.randint(1000, 9999)}'.encode()).hexdigest()
-        songlink = f'https://song.link/ya/{track_id}'
-        song_button = InlineKeyboardButton(text='Ссылка на трек', url=songlink)
-        bot_button = InlineKeyboardButton(text=f'@{me.username}', url=f'https://t.me/{me.username}')
-        markup = InlineKeyboardMarkup(inline_keyboard=[[song_button], [bot_button]])
-        result = InlineQueryResultAudio(
-            id=result_id,
-            title=title,
-            parse_mode='html',
-            audio_duration=duration,
-            reply_markup=markup,
-            audio_url=url,
+        result_id = make_result_id('now', track_id)
+        markup = track_markup(track_id)
+        result = audio_result(
+            result_id, track_id, file_id, url, title, artists, duration,
             caption=f'<b>Сейчас играет:</b>\n🎧 <code>{html.escape(artists)} - {html.escape(title)}</code>',
-            performer=artists
+            markup=markup
         )
         # Update statistics for successful requests
         await update_statistics(successful_requests=1)
-        return await query.answer(
+        await answer(
+            query,
             results=[result],
-            cache_time=5,
+            # Telegram may reuse the answer for as long as the result stays valid
+            cache_time=now_playing_cache.cache_time(usr['ym_token']),
             is_personal=True
         )
+        return 'degraded' if cache_only else 'success'
     else:
-        # Update statistics
-        await update_statistics(total_requests=1, successful_requests=1, daily_requests=1)
+        # Offset of the requested page, '' for the first one
+        offset = int(query.offset) if query.offset.isdigit() else 0
+        if not offset and not cache_only:
+            # Update statistics
+            await update_statistics(total_requests=1, successful_requests=1, daily_requests=1)
         
         token = usr.get('ym_token') or os.getenv('DEFAULT_YM_TOKEN')
         if not token:
-            return
+            return 'no_token'
             
-        client = await ClientAsync(token=token).init()
-        results = await client.search(query.query, type_='track')
-        if not results:
-            return await query.answer(
-                results=[],
-                cache_time=3600,
-                is_personal=False
-            )
-        if not results.tracks:
-            print(results.text if hasattr(results, 'text') else "No results text")
-            return await query.answer(
+        if cache_only:
+            tracks = search_cache.get(normalize_query(query.query))
+            if tracks is None:
+                return await answer_busy(query)
+        else:
+            if normalize_query(query.query) not in search_cache:
+                # Wait for the user to stop typing before going to Yandex
+                await inline_tracker.wait()
+            with inline_stage_seconds.time(stage='client'):
+                client = await client_pool.get(token)
+            with inline_stage_seconds.time(stage='search'):
+                tracks = await search_tracks(client, query.query)
+        if not tracks and not offset:
+            if cache_only:
+                await update_statistics(total_requests=1, successful_requests=1, daily_requests=1)
+            await answer(
+                query,
                 results=[],
                 cache_time=3600,
                 is_personal=False
             )
-        tracks = results.tracks.results[:6]
+            return 'search_empty'
+        # Only the requested page is resolved, Telegram asks for the next one when the user scrolls
+        end = offset + SEARCH_PAGE_SIZE
+        next_offset = str(end) if end < len(tracks) else ''
+        tracks = tracks[offset:end]
+        with inline_stage_seconds.time(stage='resolve'):
+            if cache_only:
+                file_ids = {str(track.id): file_id_cache.get(str(track.id)) for track in tracks}
+                file_ids = {track_id: file_id for track_id, file_id in file_ids.items() if file_id}
+            else:
+                file_ids = await get_file_ids(str(track.id) for track in tracks)
+            # Only tracks that are not stored in Telegram yet need a direct link
+            unresolved = [track for track in tracks if str(track.id) not in file_ids]
+            # Search answers are shared between users, so their links must not spend this user's token
+            shared = audio_redirects.shared
+            if audio_redirects.enabled:
+                user_id = None if shared else query.from_user.id
+                urls = {str(track.id): audio_redirects.url(str(track.id), user_id) for track in unresolved}
+            elif cache_only:
+                urls = {str(track.id): cached_direct_link(str(track.id)) for track in unresolved}
+            else:
+                urls = dict(zip((str(track.id) for track in unresolved), await resolve_direct_links(unresolved)))
         outs = []
         for track in tracks:
+            file_id = file_ids.get(str(track.id))
+            url = urls.get(str(track.id))
+            if file_id is None and url is None:
+                continue
             title = track.title or "Неизвестный трек"
             artists = ', '.join([artist.name for artist in track.artists]) if track.artists else "Неизвестный исполнитель"
             duration = (track.duration_ms or 0) // 1000
             track_id = track.track_id.split(':')[-1] if track.track_id else ""
-            dlinfo = await track.get_specific_download_info_async(codec='mp3', bitrate_in_kbps=320)
-            if dlinfo is None:
-                dlinfo = await track.get_specific_download_info_async(codec='mp3', bitrate_in_kbps=192)
-                if dlinfo is None:
-                    continue
-            url = await dlinfo.get_direct_link_async()
-            query_hash = hashlib.md5(query.query.encode()).hexdigest()
-            result_id = hashlib.md5(f'search:{query_hash}:{track_id}:{random.randint(1000, 9999)}'.encode()).hexdigest()
-            songlink = f'https://song.link/ya/{track_id}'
-            song_button = InlineKeyboardButton(text='Ссылка на трек', url=songlink)
-            bot_button = InlineKeyboardButton(text=f'@{me.username}', url=f'https://t.me/{me.username}')
-            markup = InlineKeyboardMarkup(inline_keyboard=[[song_button], [bot_button]])
-            result = InlineQueryResultAudio(
-                id=result_id,
-                title=title,
-                parse_mode='html',
-                audio_duration=duration,
-                reply_markup=markup,
-                audio_url=url,
+            result_id = make_result_id('search', str(track.id))
+            markup = track_markup(track_id)
+            result = audio_result(
+                result_id, str(track.id), file_id, url, title, artists, duration,
                 caption=f'<b>Трек по запросу "<i>{html.escape(query.query)}</i>":</b>\n🎧 <code>{html.escape(artists)} - {html.escape(title)}</code>',
-                performer=artists
+                markup=markup
             )
             outs.append(result)
-        return await query.answer(
+        if cache_only and not outs:
+            return await answer_busy(query)
+        if cache_only and not offset:
+            # Shed queries are counted only once they are known to be answered from caches
+            await update_statistics(total_requests=1, successful_requests=1, daily_requests=1)
+        await answer(
+            query,
             results=outs,
-            cache_time=86400,
-            is_personal=False
+            # Tracks without a cached link are missing from a degraded answer, so Telegram shouldn't keep it
+            cache_time=INLINE_DEGRADED_CACHE_TIME if cache_only else 86400,
+            # Without DEFAULT_YM_TOKEN redirect URLs resolve with this user's token and can't be shared
+            is_personal=audio_redirects.enabled and not shared and bool(unresolved),
+            next_offset=next_offset
         )
+        return 'degraded' if cache_only else 'success'
+
+
+@dp.chosen_inline_result()
+async def chosen_result(chosen: ChosenInlineResult):
+    """Learn which tracks users actually send and upload them, so next time they are answered by file_id."""
+    parsed = parse_result_id(chosen.result_id)
+    if parsed:
+        kind, track_id = parsed
+        popularity.record(kind, track_id, chosen.query)
+        audio_uploader.chosen(track_id)
 
 
 @dp.message(CommandStart())
@@ -449,19 +651,8 @@ async def start(message: Message):
         'ym_id': usr_data.ym_id,
         'ym_token': usr_data.ym_token
     }
-    
-    me = await bot.get_me()
+
     if not usr.get('ym_token'):
-        button = InlineKeyboardButton(
-            text='Или нажми на эту кнопку и выбери чат :)',
-            switch_inline_query_chosen_chat=SwitchInlineQueryChosenChat(
-                query='',
-                allow_user_chats=True,
-                allow_bot_chats=True,
-                allow_group_chats=True,
-                allow_channel_chats=True)
-        )
-        markup = InlineKeyboardMarkup(inline_keyboard=[[button]])
         await message.answer(
             f'<b>Привет 👋</b>\n'
             f'Я помогу тебе делиться с другими музыкой которую ты слушаешь 🎧\n\n'
@@ -473,20 +664,9 @@ async def start(message: Message):
             f'<a href="https://yandex-music.readthedocs.io/en/main/token.html">🔮 Как получить токен 🔮</a>',
             parse_mode='html',
             disable_web_page_preview=True,
-            reply_markup=markup
+            reply_markup=new_user_markup
         )
     else:
-        me = await bot.get_me()
-        button = InlineKeyboardButton(
-            text='Либо нажмите на эту кнопку и выберите чат :)',
-            switch_inline_query_chosen_chat=SwitchInlineQueryChosenChat(
-                query='',
-                allow_user_chats=True,
-                allow_bot_chats=True,
-                allow_group_chats=True,
-                allow_channel_chats=True)
-        )
-        markup = InlineKeyboardMarkup(inline_keyboard=[[button]])
         await message.answer(
             '<b>Всё готово ✅</b>\n'
             f'Теперь в любом чате ты можешь написать (не отправляя) <code>@{me.username} </code>, '
@@ -495,7 +675,7 @@ async def start(message: Message):
             f'просто напиши <code>@{me.username} [запрос]</code> и подожди несколько секунд.\n\n'
             f'Если захочешь удалить свой токен из базы данных бота, используй команду /reset.\n\n'
             f'Для просмотра статистики используй команду /stats',
-            reply_markup=markup,
+            reply_markup=ready_markup,
             parse_mode='html'
         )
 
@@ -511,6 +691,9 @@ async def reset_token(message: Message):
     }
     
     await update_user(usr['id'], {'ym_token': None, 'ym_id': None})
+    client_pool.invalidate(usr['ym_token'])
+    await ynison_manager.invalidate(usr['ym_token'])
+    now_playing_cache.forget(usr['ym_token'])
     await message.answer(
         '<b>Готово ✅</b>\n'
         'Твой токен и ID стёрты из базы данных бота и больше не смогут использоваться.\n'
@@ -524,7 +707,6 @@ async def reset_token(message: Message):
 
 @dp.message(F.text.regexp(r'^/token\s+(\S+)$'))
 async def set_token(message: Message):
-    me = await bot.get_me()
     usr_data = await handle_user(message.from_user.id)
     # Convert user data to dict for compatibility
     usr: Dict[str, Any] = {
@@ -547,7 +729,7 @@ async def set_token(message: Message):
     token = match.group(1)
 
     try:
-        client = ClientAsync(token=token)
+        client = client_pool.create_client(token)
         await client.init()
         if client.me and client.me.account:
             uid = client.me.account.uid
@@ -558,6 +740,12 @@ async def set_token(message: Message):
         await message.answer('Произошла ошибка при проверке токена. Попробуй ещё раз.')
         return
         
+    if usr.get('ym_token') != token:
+        client_pool.invalidate(usr.get('ym_token'))
+        await ynison_manager.invalidate(usr.get('ym_token'))
+        now_playing_cache.forget(usr.get('ym_token'))
+    client_pool.put(token, client)
+
     if uid != -1:
         await update_user(usr['id'], {'ym_token': token, 'ym_id': uid})
         await message.answer(
@@ -581,47 +769,125 @@ async def set_token(message: Message):
     )
 
 
-async def reset_daily_statistics():
-    """Background task to reset daily statistics at midnight."""
-    from src.database.statistics_operations import get_latest_statistics, reset_daily_if_needed
-    while True:
-        try:
-            # Wait until midnight
-            now = datetime.now()
-            # Calculate seconds until next midnight
-            tomorrow = now + timedelta(days=1)
-            midnight = tomorrow.replace(hour=0, minute=0, second=0, microsecond=0)
-            seconds_until_midnight = (midnight - now).total_seconds()
-            
-            # Wait until midnight
-            await asyncio.sleep(seconds_until_midnight)
-            
-            # Reset daily statistics
-            stats = await get_latest_statistics()
-            if stats:
-                await reset_daily_if_needed(stats)
-            
-            # Wait a bit more to ensure we're past midnight
-            await asyncio.sleep(60)
-        except Exception as e:
-            logger.error(f"Error in daily reset task: {e}")
-            await asyncio.sleep(3600)  # Wait 1 hour before retrying
+async def startup(worker_index: int = 0, create_tables: bool = True) -> List[asyncio.Task]:
+    """Prepare the database and start background tasks. Returns the tasks to cancel on shutdown.
+
+    Webhook workers pass create_tables=False: the tables are created once by the parent
+    process before they start, since concurrent CREATE TABLE can fail in Postgres.
+    """
+    # Create tables if they don't exist
+    from src.database.session import init_db
+
+    from src.database.statistics_operations import statistics_aggregator, statistics_snapshotter
+
+    if create_tables:
+        await init_db()
+    await load_identity()
+
+    tasks = [
+        # Statistics flush and snapshot tasks
+        asyncio.create_task(statistics_aggregator.run()),
+        # Rolling up old hourly buckets in one process only
+        asyncio.create_task(statistics_snapshotter.run(rollup=worker_index == 0)),
+        # Closing idle Ynison connections
+        asyncio.create_task(ynison_manager.run()),
+        # Revalidating and prefetching now-playing results
+        asyncio.create_task(now_playing_cache.run(prefetch_now_playing)),
+        # Refreshing popular direct links
+        asyncio.create_task(hot_links.run()),
+        # Counting chosen results and warming caches for popular ones
+        asyncio.create_task(popularity.run()),
+        # Uploading sent tracks to the storage chat
+        asyncio.create_task(audio_uploader.run(bot)),
+    ]
+
+    if METRICS_PORT:
+        # Each webhook worker exposes its own metrics on the next port
+        runner = await serve_metrics(METRICS_PORT + worker_index)
+        tasks.append(asyncio.create_task(cleanup_on_cancel(runner)))
+
+    if audio_redirects.enabled and worker_index == 0:
+        # One process serves the endpoint, the URLs carry everything needed to resolve them
+        runner = await audio_redirects.serve()
+        tasks.append(asyncio.create_task(cleanup_on_cancel(runner)))
+
+    if worker_index == 0:
+        # Resume a broadcast interrupted by the previous shutdown, in one process only
+        broadcast = await get_unfinished_broadcast()
+        if broadcast:
+            await start_broadcast(broadcast)
+    return tasks
+
+
+async def cleanup_on_cancel(runner: web.AppRunner) -> None:
+    """Keep an aiohttp app running until the task is cancelled on shutdown."""
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def shutdown(tasks: List[asyncio.Task]) -> None:
+    from src.database.session import close_db
+
+    from src.database.statistics_operations import statistics_aggregator
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await broadcast_engine.stop()
+    await statistics_aggregator.flush()
+    await popularity.flush()
+    await ynison_manager.close()
+    client_pool.close()
+    await http_pool.close()
+    await close_db()
 
 
 async def main():
-    # Create tables if they don't exist
-    from src.models.user import User
-    from src.models.statistics import Statistics
-    from src.database.session import engine
-    
-    User.metadata.create_all(engine)
-    Statistics.metadata.create_all(engine)
-    
-    # Start the daily reset task
-    asyncio.create_task(reset_daily_statistics())
-    
-    await dp.start_polling(bot)
+    tasks = await startup()
+    try:
+        if BOT_MODE == 'webhook':
+            await set_webhook(bot, dp)
+            await serve_dispatcher(bot, dp)
+        else:
+            await dp.start_polling(bot)
+    finally:
+        await shutdown(tasks)
+
+
+def run_webhook_worker(index: int, path: str) -> None:
+    """Entry point of a webhook worker process serving updates routed to the unix socket path."""
+    async def worker():
+        task = asyncio.current_task()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+        tasks = await startup(worker_index=index, create_tables=False)
+        try:
+            await serve_dispatcher(bot, dp, path)
+        finally:
+            await shutdown(tasks)
+
+    try:
+        asyncio.run(worker())
+    except (asyncio.CancelledError, KeyboardInterrupt):
+        pass
+
+
+async def register_webhook() -> None:
+    await set_webhook(bot, dp)
+    await http_pool.close()
+
+
+async def prepare_database() -> None:
+    """Create the tables once, before the webhook workers start."""
+    from src.database.session import close_db, init_db
+
+    await init_db()
+    await close_db()
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    if BOT_MODE == 'webhook' and WEBHOOK_WORKERS > 1:
+        run_workers(run_webhook_worker, register_webhook, prepare=prepare_database)
+    else:
+        asyncio.run(main())
@@ -0,0 +1,3 @@
+from .lru import TTLCache
+
+__all__ = ['TTLCache']
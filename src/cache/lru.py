@@ -0,0 +1,95 @@
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Generic, Hashable, Optional, TypeVar
+
+V = TypeVar('V')
+
+
+class TTLCache(Generic[V]):
+    """Bounded LRU cache with per-entry expiry and hit/miss counters.
+
+    Bounded by entry count, and with weigh also by the total weight of the values,
+    e.g. an estimate of their memory, for values whose sizes vary a lot.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, maxweight: Optional[int] = None,
+                 weigh: Optional[Callable[[V], int]] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxweight = maxweight
+        self._weigh = weigh
+        self.weight = 0
+        # key -> (expires_at, value, weight)
+        self._data: OrderedDict[Hashable, tuple[float, V, int]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._data.get(key)
+        return entry is not None and entry[0] > time.monotonic()
+
+    def get(self, key: Hashable, default: Optional[V] = None) -> Optional[V]:
+        """Get a value and mark it as recently used. Expired entries count as misses."""
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        expires_at, value, weight = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.weight -= weight
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: V, ttl: Optional[float] = None) -> None:
+        """Store a value, evicting the least recently used entries if the cache is full."""
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        weight = self._weigh(value) if self._weigh else 0
+        previous = self._data.get(key)
+        if previous is not None:
+            self.weight -= previous[2]
+        self._data[key] = (expires_at, value, weight)
+        self.weight += weight
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize or (
+                self.maxweight is not None and self.weight > self.maxweight and len(self._data) > 1):
+            self.weight -= self._data.popitem(last=False)[1][2]
+            self.evictions += 1
+
+    def expires_in(self, key: Hashable) -> Optional[float]:
+        """Seconds until the entry expires, or None if it is missing or already expired."""
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        remaining = entry[0] - time.monotonic()
+        return remaining if remaining > 0 else None
+
+    def pop(self, key: Hashable, default: Optional[V] = None) -> Optional[V]:
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return default
+        self.weight -= entry[2]
+        return entry[1]
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.weight = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'weight': self.weight,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
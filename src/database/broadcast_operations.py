@@ -0,0 +1,46 @@
+from ..models.broadcast import Broadcast
+from ..database.session import get_async_session
+from sqlmodel import select, update
+from typing import Optional
+from datetime import datetime
+
+RUNNING = "running"
+DONE = "done"
+
+
+async def create_broadcast(text: str, chat_id: int) -> Broadcast:
+    """Create a broadcast that starts from the first user."""
+    async with get_async_session() as session:
+        broadcast = Broadcast(text=text, chat_id=chat_id)
+        session.add(broadcast)
+        await session.commit()
+        return broadcast
+
+
+async def get_unfinished_broadcast() -> Optional[Broadcast]:
+    """Get the oldest broadcast that was interrupted before reaching every user."""
+    async with get_async_session() as session:
+        statement = select(Broadcast).where(Broadcast.status == RUNNING).order_by(Broadcast.id).limit(1)
+        result = await session.exec(statement)
+        return result.first()
+
+
+async def save_broadcast_progress(broadcast_id: int, last_user_id: int, sent: int, failed: int, blocked: int) -> None:
+    """Checkpoint a broadcast after a batch of users has been processed."""
+    async with get_async_session() as session:
+        await session.execute(
+            update(Broadcast)
+            .where(Broadcast.id == broadcast_id)
+            .values(last_user_id=last_user_id, sent=sent, failed=failed, blocked=blocked)
+        )
+        await session.commit()
+
+
+async def finish_broadcast(broadcast_id: int) -> None:
+    async with get_async_session() as session:
+        await session.execute(
+            update(Broadcast)
+            .where(Broadcast.id == broadcast_id)
+            .values(status=DONE, finished_at=datetime.utcnow())
+        )
+        await session.commit()
@@ -0,0 +1,62 @@
+from ..models.chosen_result import ChosenResult
+from ..database.session import get_async_session
+from sqlmodel import select, func, delete
+from sqlalchemy.dialects.postgresql import insert
+from typing import Dict, List, Tuple
+from datetime import datetime
+
+# (kind, track id, query)
+ChosenKey = Tuple[str, str, str]
+
+
+async def add_chosen_results(day: datetime, counts: Dict[ChosenKey, int]) -> None:
+    """Add chosen result counts to the day's rows in one statement, creating rows as needed."""
+    if not counts:
+        return
+    statement = insert(ChosenResult).values([
+        {'day': day, 'kind': kind, 'track_id': track_id, 'query': query, 'count': count}
+        for (kind, track_id, query), count in counts.items()
+    ])
+    statement = statement.on_conflict_do_update(
+        index_elements=[ChosenResult.day, ChosenResult.kind, ChosenResult.track_id, ChosenResult.query],
+        set_={'count': ChosenResult.count + statement.excluded.count},
+    )
+    async with get_async_session() as session:
+        await session.execute(statement)
+        await session.commit()
+
+
+async def get_top_tracks(since: datetime, limit: int) -> List[Tuple[str, int]]:
+    """Tracks sent most often since the given day, with their counts."""
+    total = func.sum(ChosenResult.count)
+    async with get_async_session() as session:
+        statement = (
+            select(ChosenResult.track_id, total)
+            .where(ChosenResult.day >= since)
+            .group_by(ChosenResult.track_id)
+            .order_by(total.desc())
+            .limit(limit)
+        )
+        result = await session.exec(statement)
+        return [(track_id, int(count)) for track_id, count in result.all()]
+
+
+async def get_top_queries(since: datetime, limit: int) -> List[Tuple[str, int]]:
+    """Search queries whose results were sent most often since the given day, with their counts."""
+    total = func.sum(ChosenResult.count)
+    async with get_async_session() as session:
+        statement = (
+            select(ChosenResult.query, total)
+            .where(ChosenResult.day >= since, ChosenResult.kind == 'search', ChosenResult.query != '')
+            .group_by(ChosenResult.query)
+            .order_by(total.desc())
+            .limit(limit)
+        )
+        result = await session.exec(statement)
+        return [(query, int(count)) for query, count in result.all()]
+
+
+async def delete_chosen_results_before(day: datetime) -> None:
+    async with get_async_session() as session:
+        await session.execute(delete(ChosenResult).where(ChosenResult.day < day))
+        await session.commit()
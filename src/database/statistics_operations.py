@@ -1,87 +1,279 @@
 from ..models.statistics import Statistics
+from ..models.statistics_bucket import StatisticsBucket
 from ..models.user import User
-from ..database.session import get_session
-from sqlmodel import select
-from typing import Optional
-from datetime import datetime, date
+from ..database.session import get_async_session
+from sqlmodel import select, func, delete, literal
+from sqlalchemy.dialects.postgresql import insert
+from typing import Optional, Dict
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from loguru import logger
+import asyncio
+import os
+
+# How often the in-memory request counters are written to the database
+STATISTICS_FLUSH_INTERVAL = float(os.getenv("STATISTICS_FLUSH_INTERVAL", "10"))
+# How often the /stats snapshot is recomputed from the database
+STATISTICS_SNAPSHOT_INTERVAL = float(os.getenv("STATISTICS_SNAPSHOT_INTERVAL", "60"))
+# Hourly buckets older than this are rolled up into daily buckets
+STATISTICS_HOURLY_RETENTION_DAYS = int(os.getenv("STATISTICS_HOURLY_RETENTION_DAYS", "7"))
+
+HOUR = "hour"
+DAY = "day"
+
+
+def _truncate_to_hour(moment: datetime) -> datetime:
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def _truncate_to_day(moment: datetime) -> datetime:
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
 
 
 async def get_user_count() -> int:
     """Get the total number of users from the database."""
-    with next(get_session()) as session:
-        statement = select(User)
-        result = session.exec(statement)
-        return len(result.all())
+    async with get_async_session() as session:
+        statement = select(func.count()).select_from(User)
+        result = await session.exec(statement)
+        return result.one()
 
 
 async def get_latest_statistics() -> Optional[Statistics]:
-    """Get the latest statistics record."""
-    with next(get_session()) as session:
-        statement = select(Statistics)
-        result = session.exec(statement)
-        # Get all results and find the one with the highest ID
-        stats = result.all()
-        if stats:
-            return max(stats, key=lambda x: x.id or 0)
-        return None
-
-
-async def create_statistics(total_requests: int = 0, successful_requests: int = 0, users: int = 0, daily_requests: int = 0) -> Statistics:
-    """Create a new statistics record."""
-    with next(get_session()) as session:
-        # Get actual user count from database
-        user_count = await get_user_count()
-        stats = Statistics(
-            total_requests=total_requests,
-            successful_requests=successful_requests,
-            users=user_count,
+    """Get the latest statistics record.
+
+    Since the introduction of statistics buckets this row is only a baseline
+    holding the totals accumulated before bucketing (e.g. migrated from stats.json).
+    """
+    async with get_async_session() as session:
+        statement = select(Statistics).order_by(Statistics.id.desc()).limit(1)
+        result = await session.exec(statement)
+        return result.first()
+
+
+def _add_on_conflict(statement):
+    """Make a bucket INSERT add its counters to an already existing bucket."""
+    return statement.on_conflict_do_update(
+        index_elements=[StatisticsBucket.period, StatisticsBucket.bucket_start],
+        set_={
+            'total_requests': StatisticsBucket.total_requests + statement.excluded.total_requests,
+            'successful_requests': StatisticsBucket.successful_requests + statement.excluded.successful_requests,
+            'new_users': StatisticsBucket.new_users + statement.excluded.new_users,
+        },
+    )
+
+
+async def add_to_bucket(bucket_start: datetime, total_requests: int = 0, successful_requests: int = 0, new_users: int = 0) -> None:
+    """Atomically add counters to an hourly bucket, creating it if needed."""
+    statement = _add_on_conflict(insert(StatisticsBucket).values(
+        period=HOUR,
+        bucket_start=bucket_start,
+        total_requests=total_requests,
+        successful_requests=successful_requests,
+        new_users=new_users,
+    ))
+    async with get_async_session() as session:
+        await session.execute(statement)
+        await session.commit()
+
+
+async def rollup_hourly_buckets(older_than: datetime) -> None:
+    """Merge hourly buckets from days before older_than into daily buckets."""
+    cutoff = _truncate_to_day(older_than)
+    day_start = func.date_trunc(DAY, StatisticsBucket.bucket_start)
+    rollup = (
+        select(
+            literal(DAY),
+            day_start,
+            func.sum(StatisticsBucket.total_requests),
+            func.sum(StatisticsBucket.successful_requests),
+            func.sum(StatisticsBucket.new_users),
+        )
+        .where(StatisticsBucket.period == HOUR, StatisticsBucket.bucket_start < cutoff)
+        .group_by(day_start)
+    )
+    statement = _add_on_conflict(insert(StatisticsBucket).from_select(
+        ['period', 'bucket_start', 'total_requests', 'successful_requests', 'new_users'],
+        rollup,
+    ))
+    async with get_async_session() as session:
+        await session.execute(statement)
+        await session.execute(
+            delete(StatisticsBucket).where(
+                StatisticsBucket.period == HOUR,
+                StatisticsBucket.bucket_start < cutoff,
+            )
+        )
+        await session.commit()
+
+
+class StatisticsAggregator:
+    """Accumulates statistics deltas in memory, per hourly bucket, and adds them to the buckets."""
+
+    FIELDS = ('total_requests', 'successful_requests', 'users', 'daily_requests')
+
+    def __init__(self, flush_interval: float = STATISTICS_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        # Deltas by the start of the hour they were recorded in
+        self._pending: Dict[datetime, Dict[str, int]] = {}
+        self._lock = asyncio.Lock()
+
+    @property
+    def pending(self) -> Dict[str, int]:
+        return self.pending_since(datetime.min)
+
+    def pending_since(self, start: datetime) -> Dict[str, int]:
+        """Sum of the deltas recorded since start that have not been flushed yet."""
+        totals = dict.fromkeys(self.FIELDS, 0)
+        for bucket_start, deltas in self._pending.items():
+            if bucket_start >= start:
+                for name, value in deltas.items():
+                    totals[name] += value
+        return totals
+
+    def add(self, total_requests: int = 0, successful_requests: int = 0, users: int = 0, daily_requests: int = 0) -> None:
+        bucket_start = _truncate_to_hour(datetime.utcnow())
+        deltas = self._pending.get(bucket_start)
+        if deltas is None:
+            deltas = self._pending[bucket_start] = dict.fromkeys(self.FIELDS, 0)
+        deltas['total_requests'] += total_requests
+        deltas['successful_requests'] += successful_requests
+        deltas['users'] += users
+        deltas['daily_requests'] += daily_requests
+
+    async def flush(self) -> None:
+        """Write pending deltas to their buckets in the database."""
+        async with self._lock:
+            buckets, self._pending = self._pending, {}
+            for bucket_start in sorted(buckets):
+                deltas = buckets[bucket_start]
+                if not any(deltas.values()):
+                    continue
+                try:
+                    await self._write(bucket_start, deltas)
+                except Exception:
+                    # Put back the deltas not written yet so they are retried on the next flush
+                    for start, unwritten in buckets.items():
+                        if start < bucket_start:
+                            continue
+                        merged = self._pending.setdefault(start, dict.fromkeys(self.FIELDS, 0))
+                        for name, value in unwritten.items():
+                            merged[name] += value
+                    raise
+
+    async def _write(self, bucket_start: datetime, deltas: Dict[str, int]) -> None:
+        # daily_requests is not stored: it is the sum of today's hourly buckets
+        await add_to_bucket(
+            bucket_start,
+            total_requests=deltas['total_requests'],
+            successful_requests=deltas['successful_requests'],
+            new_users=deltas['users'],
+        )
+
+    async def run(self) -> None:
+        """Background task flushing the counters every flush_interval seconds."""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing statistics: {e}")
+
+
+statistics_aggregator = StatisticsAggregator()
+
+
+async def update_statistics(total_requests: int = 0, successful_requests: int = 0, users: int = 0, daily_requests: int = 0) -> None:
+    """Record statistics deltas. They are written to the database by statistics_aggregator."""
+    statistics_aggregator.add(total_requests, successful_requests, users, daily_requests)
+
+
+@dataclass
+class StatisticsSnapshot:
+    total_requests: int = 0
+    successful_requests: int = 0
+    daily_requests: int = 0
+    users: int = 0
+    day: datetime = field(default_factory=lambda: _truncate_to_day(datetime.utcnow()))
+    refreshed_at: Optional[datetime] = None
+
+
+class StatisticsSnapshotter:
+    """Keeps an in-memory copy of the bot statistics so /stats costs no database work."""
+
+    def __init__(self, aggregator: StatisticsAggregator, refresh_interval: float = STATISTICS_SNAPSHOT_INTERVAL):
+        self.aggregator = aggregator
+        self.refresh_interval = refresh_interval
+        self._snapshot = StatisticsSnapshot()
+        self._last_rollup: Optional[datetime] = None
+
+    def current(self) -> StatisticsSnapshot:
+        """The last database snapshot plus counters that have not been flushed yet."""
+        snapshot = self._snapshot
+        pending = self.aggregator.pending
+        today = _truncate_to_day(datetime.utcnow())
+        daily_requests = snapshot.daily_requests
+        if today > snapshot.day:
+            # The day has changed since the last refresh
+            daily_requests = 0
+        # Deltas still pending from before midnight belong to yesterday
+        daily_pending = self.aggregator.pending_since(today)
+        return StatisticsSnapshot(
+            total_requests=snapshot.total_requests + pending['total_requests'],
+            successful_requests=snapshot.successful_requests + pending['successful_requests'],
+            daily_requests=daily_requests + daily_pending['daily_requests'],
+            users=snapshot.users,
+            day=snapshot.day,
+            refreshed_at=snapshot.refreshed_at,
+        )
+
+    async def refresh(self) -> StatisticsSnapshot:
+        """Recompute the snapshot from the baseline row and the buckets table."""
+        await self.aggregator.flush()
+
+        now = datetime.utcnow()
+        today = _truncate_to_day(now)
+        async with get_async_session() as session:
+            baseline = (await session.exec(
+                select(Statistics).order_by(Statistics.id.desc()).limit(1)
+            )).first()
+            totals = (await session.exec(
+                select(
+                    func.coalesce(func.sum(StatisticsBucket.total_requests), 0),
+                    func.coalesce(func.sum(StatisticsBucket.successful_requests), 0),
+                )
+            )).one()
+            daily_requests = (await session.exec(
+                select(func.coalesce(func.sum(StatisticsBucket.total_requests), 0))
+                .where(StatisticsBucket.period == HOUR, StatisticsBucket.bucket_start >= today)
+            )).one()
+            users = (await session.exec(select(func.count()).select_from(User))).one()
+
+        self._snapshot = StatisticsSnapshot(
+            total_requests=(baseline.total_requests if baseline else 0) + totals[0],
+            successful_requests=(baseline.successful_requests if baseline else 0) + totals[1],
             daily_requests=daily_requests,
-            last_reset=datetime.utcnow()
+            users=users,
+            day=today,
+            refreshed_at=now,
         )
-        session.add(stats)
-        session.commit()
-        session.refresh(stats)
-        return stats
-
-
-async def reset_daily_if_needed(stats: Statistics) -> bool:
-    """Reset daily requests if the day has changed. Returns True if reset was performed."""
-    if not stats.last_reset:
-        return False
-    
-    # Check if the last reset was today
-    last_reset_date = stats.last_reset.date()
-    today = date.today()
-    
-    if last_reset_date < today:
-        # Reset daily requests
-        with next(get_session()) as session:
-            stats.daily_requests = 0
-            stats.last_reset = datetime.utcnow()
-            session.add(stats)
-            session.commit()
-            session.refresh(stats)
-        return True
-    return False
-
-
-async def update_statistics(total_requests: int = 0, successful_requests: int = 0, users: int = 0, daily_requests: int = 0) -> Statistics:
-    """Update or create statistics."""
-    stats = await get_latest_statistics()
-    if not stats:
-        stats = await create_statistics(total_requests, successful_requests, users, daily_requests)
-    else:
-        with next(get_session()) as session:
-            # Check if we need to reset daily requests
-            await reset_daily_if_needed(stats)
-            
-            stats.total_requests += total_requests
-            stats.successful_requests += successful_requests
-            # Only update user count when a new user is added
-            if users > 0:
-                stats.users += users
-            stats.daily_requests += daily_requests
-            session.add(stats)
-            session.commit()
-            session.refresh(stats)
-    return stats
+        return self._snapshot
+
+    async def run(self, rollup: bool = True) -> None:
+        """Background task refreshing the snapshot and, with rollup, rolling up old hourly buckets.
+
+        Concurrent rollups could add the same hourly rows to a daily bucket twice, so
+        only one process may run with rollup.
+        """
+        while True:
+            try:
+                await self.refresh()
+                today = _truncate_to_day(datetime.utcnow())
+                if rollup and self._last_rollup != today:
+                    await rollup_hourly_buckets(today - timedelta(days=STATISTICS_HOURLY_RETENTION_DAYS))
+                    self._last_rollup = today
+            except Exception as e:
+                logger.error(f"Error refreshing statistics snapshot: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+
+statistics_snapshotter = StatisticsSnapshotter(statistics_aggregator)
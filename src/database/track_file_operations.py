@@ -0,0 +1,56 @@
+from ..models.track_file import TrackFile
+from ..database.session import get_async_session
+from ..cache import TTLCache
+from sqlmodel import select
+from sqlalchemy.dialects.postgresql import insert
+from typing import Dict, Iterable, Optional
+import os
+
+FILE_ID_CACHE_SIZE = int(os.getenv("FILE_ID_CACHE_SIZE", "100000"))
+FILE_ID_CACHE_TTL = float(os.getenv("FILE_ID_CACHE_TTL", "86400"))
+# Tracks without a stored file are not looked up again for this long
+FILE_ID_MISS_TTL = float(os.getenv("FILE_ID_MISS_TTL", "300"))
+
+# Telegram file_id by track id. An empty string means the track has no stored file.
+file_id_cache: TTLCache[str] = TTLCache(maxsize=FILE_ID_CACHE_SIZE, ttl=FILE_ID_CACHE_TTL)
+
+
+async def get_file_ids(track_ids: Iterable[str]) -> Dict[str, str]:
+    """Get stored Telegram file_ids for the tracks that have one."""
+    found: Dict[str, str] = {}
+    missing = []
+    for track_id in track_ids:
+        file_id = file_id_cache.get(track_id)
+        if file_id is None:
+            missing.append(track_id)
+        elif file_id:
+            found[track_id] = file_id
+    if not missing:
+        return found
+
+    async with get_async_session() as session:
+        statement = select(TrackFile).where(TrackFile.track_id.in_(missing))
+        result = await session.exec(statement)
+        rows = {row.track_id: row.file_id for row in result.all()}
+    for track_id in missing:
+        file_id = rows.get(track_id)
+        if file_id:
+            file_id_cache.set(track_id, file_id)
+            found[track_id] = file_id
+        else:
+            file_id_cache.set(track_id, '', ttl=FILE_ID_MISS_TTL)
+    return found
+
+
+async def save_file_id(track_id: str, file_id: str, file_unique_id: Optional[str] = None) -> None:
+    """Store the Telegram file_id of an uploaded track, replacing an older one."""
+    statement = insert(TrackFile).values(track_id=track_id, file_id=file_id, file_unique_id=file_unique_id)
+    statement = statement.on_conflict_do_update(
+        index_elements=[TrackFile.track_id],
+        set_={'file_id': statement.excluded.file_id, 'file_unique_id': statement.excluded.file_unique_id},
+    )
+    async with get_async_session() as session:
+        await session.execute(statement)
+        await session.commit()
+    file_id_cache.set(track_id, file_id)
+
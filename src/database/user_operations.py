@@ -1,55 +1,89 @@
 from ..models.user import User
-from ..database.session import get_session
+from ..database.session import get_async_session
+from ..cache import TTLCache
 from sqlmodel import select
-from typing import Optional, List
+from sqlalchemy.exc import IntegrityError
+from typing import Optional, List, AsyncIterator
+import asyncio
+import os
 
+# In-process cache of users, read through by get_user/handle_user.
+# Writes go through update_user, so token changes take effect immediately.
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "600"))
 
-async def get_user(user_id: int) -> Optional[User]:
-    """Get a user by ID."""
-    with next(get_session()) as session:
-        statement = select(User).where(User.id == user_id)
-        result = session.exec(statement)
-        return result.first()
+user_cache: TTLCache[User] = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
 
 
-async def get_all_users() -> List[User]:
-    """Get all users from the database."""
-    with next(get_session()) as session:
-        statement = select(User)
-        result = session.exec(statement)
-        return result.all()
+async def get_user(user_id: int, use_cache: bool = True) -> Optional[User]:
+    """Get a user by ID.
+
+    With use_cache=False the cache is not read, but the fresh row is still stored.
+    """
+    user = user_cache.get(user_id) if use_cache else None
+    if user is not None:
+        return user
+
+    async with get_async_session() as session:
+        user = await session.get(User, user_id)
+    if user:
+        user_cache.set(user_id, user)
+    return user
+
+
+async def iter_user_id_batches(after_id: int = 0, batch_size: int = 1000) -> AsyncIterator[List[int]]:
+    """Yield user ids in ascending order, batch_size at a time, starting after after_id.
+
+    Uses keyset pagination, so only one batch is held in memory.
+    """
+    while True:
+        async with get_async_session() as session:
+            statement = select(User.id).where(User.id > after_id).order_by(User.id).limit(batch_size)
+            result = await session.exec(statement)
+            batch = list(result.all())
+        if not batch:
+            return
+        yield batch
+        after_id = batch[-1]
 
 
 async def create_user(user_id: int) -> User:
     """Create a new user."""
-    with next(get_session()) as session:
+    async with get_async_session() as session:
         user = User(id=user_id)
         session.add(user)
-        session.commit()
-        session.refresh(user)
-        
-        # Update statistics when a new user is created
-        from src.database.statistics_operations import update_statistics
-        import asyncio
-        asyncio.create_task(update_statistics(users=1))
-        
-        return user
+        try:
+            await session.commit()
+        except IntegrityError:
+            # Another concurrent request has already created this user
+            await session.rollback()
+            user = await session.get(User, user_id)
+            if user:
+                user_cache.set(user_id, user)
+            return user
+
+    user_cache.set(user_id, user)
+
+    # Update statistics when a new user is created
+    from src.database.statistics_operations import update_statistics
+    asyncio.create_task(update_statistics(users=1))
+
+    return user
 
 
 async def update_user(user_id: int, update_fields: dict) -> Optional[User]:
     """Update user fields."""
-    with next(get_session()) as session:
-        statement = select(User).where(User.id == user_id)
-        result = session.exec(statement)
-        user = result.first()
-        
+    async with get_async_session() as session:
+        user = await session.get(User, user_id)
+
         if user:
             for field, value in update_fields.items():
                 setattr(user, field, value)
             session.add(user)
-            session.commit()
-            session.refresh(user)
+            await session.commit()
+            user_cache.set(user_id, user)
             return user
+        user_cache.pop(user_id)
         return None
 
 
@@ -1,6 +1,26 @@
+#!/usr/bin/env python3
+"""
+Migration of users from the old SQLite database and statistics from stats.json to PostgreSQL.
+
+Users are read from SQLite in chunks ordered by id and written with one
+INSERT ... ON CONFLICT DO NOTHING per chunk, so memory stays flat and rows that
+already exist are left alone. After every committed chunk the last migrated id is
+written to a checkpoint file; an interrupted run picks up from there when started
+again. Replaying a chunk is harmless, so a crash between the commit and the
+checkpoint costs nothing.
+
+Usage:
+    python -m src.migrations.migrate_sqlite_to_postgres --db db.sqlite3 --chunk-size 5000
+    python -m src.migrations.migrate_sqlite_to_postgres --restart
+"""
+
+import argparse
+import json
 import sqlite3
 import os
 import sys
+import time
+from typing import Any, Dict, Optional
 
 # Add the parent directory to the path
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
@@ -8,66 +28,121 @@ sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 from ..models.user import User
 from ..models.statistics import Statistics
 from ..database.session import engine
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
 from sqlmodel import Session, select
 
+# Rows per INSERT; three parameters per row stay well below the 65535 Postgres allows
+DEFAULT_CHUNK_SIZE = 5000
+# Seconds between progress lines
+PROGRESS_INTERVAL = 5
+
+
+def _read_checkpoint(path: str) -> Dict[str, Any]:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def _write_checkpoint(path: str, checkpoint: Dict[str, Any]) -> None:
+    # Written to a temporary file first so an interruption never leaves a broken checkpoint
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def _print_progress(done: int, total: int, inserted: int, started: float) -> None:
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    print(f"{done}/{total} users read, {inserted} inserted, {done / elapsed:.0f} rows/s")
+
+
+def migrate_users(db_path: str = "db.sqlite3", chunk_size: int = DEFAULT_CHUNK_SIZE,
+                  checkpoint_path: Optional[str] = None, restart: bool = False) -> int:
+    """Migrate users from SQLite to PostgreSQL, resuming from the checkpoint. Returns the rows read."""
+    checkpoint_path = checkpoint_path or f"{db_path}.migration.json"
+    if restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    checkpoint = _read_checkpoint(checkpoint_path)
+    last_id = checkpoint.get("last_id")
+    if last_id is not None:
+        print(f"Resuming after user {last_id} ({checkpoint.get('read', 0)} users migrated before)")
 
-def migrate_users(db_path: str = "db.sqlite3"):
-    """Migrate users from SQLite to PostgreSQL."""
     # Create tables
     User.metadata.create_all(engine)
     Statistics.metadata.create_all(engine)
-    
+
     # Connect to SQLite database
     sqlite_conn = sqlite3.connect(db_path)
     sqlite_cursor = sqlite_conn.cursor()
-    
-    # Get users from SQLite
-    sqlite_cursor.execute("SELECT id, ym_id, ym_token FROM users")
-    users = sqlite_cursor.fetchall()
-    
-    # Insert users into PostgreSQL
-    with Session(engine) as session:
-        for user in users:
-            user_id, ym_id, ym_token = user
-            # Check if user already exists
-            statement = select(User).where(User.id == user_id)
-            result = session.exec(statement).first()
-            
-            if not result:
-                new_user = User(id=user_id, ym_id=ym_id, ym_token=ym_token)
-                session.add(new_user)
-        
-        session.commit()
-    
-    # Close SQLite connection
-    sqlite_conn.close()
-    print(f"Migrated {len(users)} users from SQLite to PostgreSQL")
+    after_clause = "" if last_id is None else "WHERE id > ?"
+    after_params = () if last_id is None else (last_id,)
+    sqlite_cursor.execute(f"SELECT COUNT(*) FROM users {after_clause}", after_params)
+    total = sqlite_cursor.fetchone()[0]
+
+    done = inserted = 0
+    started = last_report = time.perf_counter()
+    try:
+        with Session(engine) as session:
+            while True:
+                # Keyset pagination on the primary key: every chunk is an index range scan
+                sqlite_cursor.execute(
+                    f"SELECT id, ym_id, ym_token FROM users {after_clause} ORDER BY id LIMIT ?",
+                    after_params + (chunk_size,),
+                )
+                rows = sqlite_cursor.fetchall()
+                if not rows:
+                    break
+
+                statement = insert(User).values([
+                    {"id": user_id, "ym_id": ym_id, "ym_token": ym_token} for user_id, ym_id, ym_token in rows
+                ]).on_conflict_do_nothing(index_elements=[User.id])
+                result = session.execute(statement)
+                session.commit()
+
+                last_id = rows[-1][0]
+                done += len(rows)
+                inserted += max(result.rowcount, 0)
+                checkpoint = {
+                    "last_id": last_id,
+                    "read": checkpoint.get("read", 0) + len(rows),
+                    "inserted": checkpoint.get("inserted", 0) + max(result.rowcount, 0),
+                }
+                _write_checkpoint(checkpoint_path, checkpoint)
+                after_clause, after_params = "WHERE id > ?", (last_id,)
+
+                if time.perf_counter() - last_report >= PROGRESS_INTERVAL:
+                    _print_progress(done, total, inserted, started)
+                    last_report = time.perf_counter()
+    finally:
+        # Close SQLite connection
+        sqlite_conn.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"Migrated {done} users from SQLite to PostgreSQL ({inserted} new) in {elapsed:.1f}s, "
+          f"{done / max(elapsed, 1e-9):.0f} rows/s")
+    return done
 
 
 def migrate_statistics(stats_file: str = "stats.json"):
     """Migrate statistics from JSON file to PostgreSQL."""
-    import json
-    
     # Read statistics from JSON file
     if os.path.exists(stats_file):
         with open(stats_file, "r") as f:
             stats_data = json.load(f)
-        
+
         total_requests = stats_data.get("total_requests", 0)
-        
+
         # Insert statistics into PostgreSQL
         with Session(engine) as session:
             # Check if statistics already exist
-            statement = select(Statistics)
-            result = session.exec(statement)
-            stats = result.all()
-            
-            if not stats:
+            existing = session.exec(select(Statistics.id).limit(1)).first()
+
+            if existing is None:
                 # Get actual user count from the users table
-                user_statement = select(User)
-                user_result = session.exec(user_statement)
-                user_count = len(user_result.all())
-                
+                user_count = session.exec(select(func.count()).select_from(User)).one()
+
                 stats = Statistics(
                     total_requests=total_requests,
                     successful_requests=total_requests,  # Assume all requests were successful for migration
@@ -81,6 +156,18 @@ def migrate_statistics(stats_file: str = "stats.json"):
                 print("Statistics already exist in PostgreSQL, skipping migration")
 
 
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default="db.sqlite3", help="SQLite database to read users from")
+    parser.add_argument("--stats", default="stats.json", help="JSON file to read statistics from")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="users per INSERT")
+    parser.add_argument("--checkpoint", help="checkpoint file (default: <db>.migration.json)")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and start from the first user")
+    args = parser.parse_args()
+
+    migrate_users(args.db, args.chunk_size, args.checkpoint, args.restart)
+    migrate_statistics(args.stats)
+
+
 if __name__ == "__main__":
-    migrate_users()
-    migrate_statistics()
+    main()
@@ -0,0 +1,20 @@
+from sqlmodel import SQLModel, Field
+from typing import Optional
+from datetime import datetime
+from sqlalchemy import BigInteger
+
+
+class Broadcast(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    text: str
+    # Chat that receives progress reports
+    chat_id: int = Field(sa_type=BigInteger)
+    # "running" until every user has been processed, so an interrupted broadcast is resumed
+    status: str = Field(default="running", max_length=16)
+    # Users are sent to in id order; everyone up to this id has been processed
+    last_user_id: int = Field(default=0, sa_type=BigInteger)
+    sent: int = Field(default=0)
+    failed: int = Field(default=0)
+    blocked: int = Field(default=0)
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    finished_at: Optional[datetime] = Field(default=None)
@@ -0,0 +1,13 @@
+from sqlmodel import SQLModel, Field
+from datetime import datetime
+
+
+class ChosenResult(SQLModel, table=True):
+    __tablename__ = "chosen_result"
+
+    # Daily counts of inline results users sent, by track and the query they were found with
+    day: datetime = Field(primary_key=True)
+    kind: str = Field(primary_key=True, max_length=8)
+    track_id: str = Field(primary_key=True, max_length=64)
+    query: str = Field(default='', primary_key=True, max_length=128)
+    count: int = Field(default=0)
@@ -0,0 +1,13 @@
+from sqlmodel import SQLModel, Field
+from datetime import datetime
+
+
+class StatisticsBucket(SQLModel, table=True):
+    __tablename__ = "statistics_bucket"
+
+    # "hour" buckets are written by the bot, older ones are rolled up into "day" buckets
+    period: str = Field(primary_key=True, max_length=8)
+    bucket_start: datetime = Field(primary_key=True)
+    total_requests: int = Field(default=0)
+    successful_requests: int = Field(default=0)
+    new_users: int = Field(default=0)
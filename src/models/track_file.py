@@ -0,0 +1,13 @@
+from sqlmodel import SQLModel, Field
+from typing import Optional
+from datetime import datetime
+
+
+class TrackFile(SQLModel, table=True):
+    __tablename__ = "track_file"
+
+    # Yandex Music track id -> audio already uploaded to Telegram
+    track_id: str = Field(primary_key=True, max_length=64)
+    file_id: str
+    file_unique_id: Optional[str] = Field(default=None)
+    created_at: datetime = Field(default_factory=datetime.utcnow)
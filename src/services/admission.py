@@ -0,0 +1,169 @@
+import asyncio
+import os
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+# Inline queries answered at the same time, in total and per user
+INLINE_MAX_CONCURRENT = int(os.getenv("INLINE_MAX_CONCURRENT", "200"))
+INLINE_MAX_PER_USER = int(os.getenv("INLINE_MAX_PER_USER", "1"))
+# Queries waiting for a slot; beyond this new ones are answered from caches at once
+INLINE_MAX_WAITING = int(os.getenv("INLINE_MAX_WAITING", "500"))
+# A query that waited this long for a slot is answered from caches instead
+INLINE_MAX_WAIT = float(os.getenv("INLINE_MAX_WAIT", "2"))
+# Seconds from arrival after which an answer is pointless; Telegram stops waiting at about 10
+INLINE_DEADLINE = float(os.getenv("INLINE_DEADLINE", "8"))
+# Telegram cache_time of answers given while saturated, so full answers come back soon
+INLINE_DEGRADED_CACHE_TIME = int(os.getenv("INLINE_DEGRADED_CACHE_TIME", "5"))
+
+
+class QueryExpired(Exception):
+    """The inline query outlived its deadline; Telegram no longer takes an answer."""
+
+
+class ArrivalTimeMiddleware(BaseMiddleware):
+    """Stamps every update with the loop time it entered the dispatcher, as data['arrived_at'].
+
+    Registered before the other outer middlewares, so time spent waiting in them
+    counts against the deadline of an inline query.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        data['arrived_at'] = asyncio.get_running_loop().time()
+        return await handler(event, data)
+
+
+class InlineAdmission:
+    """Admission control in front of the inline query handler.
+
+    A query runs in full only while fewer than max_concurrent queries, and fewer than
+    max_per_user of its user's, are running. Otherwise it waits in a bounded FIFO
+    queue for up to max_wait. A query that finds the queue full or waits too long is
+    degraded: it is answered from in-process caches only, or with a "busy" article,
+    and never goes upstream. Every query is cancelled once deadline seconds have
+    passed since its arrival, wherever it is, and dropped without an answer.
+
+    The inline tracker already cancels a user's previous query when a new one comes,
+    so with one slot per user the new query waits only for the old one to unwind.
+    """
+
+    def __init__(self, max_concurrent: int = INLINE_MAX_CONCURRENT, max_per_user: int = INLINE_MAX_PER_USER,
+                 max_waiting: int = INLINE_MAX_WAITING, max_wait: float = INLINE_MAX_WAIT,
+                 deadline: float = INLINE_DEADLINE):
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self.deadline = deadline
+        self._running = 0
+        self._per_user: Dict[int, int] = {}
+        self._waiters: Deque[Tuple[int, asyncio.Future]] = deque()
+        self.admitted = 0
+        self.waited = 0
+        self.degraded = 0
+        self.expired = 0
+
+    def _can_run(self, user_id: int) -> bool:
+        return self._running < self.max_concurrent and self._per_user.get(user_id, 0) < self.max_per_user
+
+    def _take(self, user_id: int) -> None:
+        self._running += 1
+        self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+
+    def _release(self, user_id: int) -> None:
+        self._running -= 1
+        self._per_user[user_id] -= 1
+        if not self._per_user[user_id]:
+            del self._per_user[user_id]
+        self._wake()
+
+    def _wake(self) -> None:
+        """Hand free slots to waiting queries in arrival order, skipping users at their limit."""
+        if not self._waiters or self._running >= self.max_concurrent:
+            return
+        for entry in list(self._waiters):
+            if self._running >= self.max_concurrent:
+                break
+            user_id, waiter = entry
+            if self._can_run(user_id):
+                self._waiters.remove(entry)
+                self._take(user_id)
+                waiter.set_result(None)
+
+    async def _acquire(self, user_id: int, wait_until: float) -> bool:
+        """Take a slot for the user. False when the query has to be degraded instead."""
+        # Slots are handed to waiters as soon as they free up, so a free one here is fair to take
+        if self._can_run(user_id):
+            self._take(user_id)
+            self.admitted += 1
+            return True
+        if len(self._waiters) >= self.max_waiting:
+            self.degraded += 1
+            return False
+
+        loop = asyncio.get_running_loop()
+        entry = (user_id, loop.create_future())
+        self._waiters.append(entry)
+        try:
+            await asyncio.wait((entry[1],), timeout=max(0.0, wait_until - loop.time()))
+        except asyncio.CancelledError:
+            # Superseded while waiting; give back a slot granted in the meantime
+            if entry[1].done():
+                self._release(user_id)
+            else:
+                self._waiters.remove(entry)
+            raise
+        if entry[1].done():
+            self.admitted += 1
+            self.waited += 1
+            return True
+        self._waiters.remove(entry)
+        self.degraded += 1
+        return False
+
+    @asynccontextmanager
+    async def admit(self, user_id: int, arrived_at: Optional[float] = None) -> AsyncIterator[bool]:
+        """Run the body as the user's query: True to answer in full, False from caches only.
+
+        Raises QueryExpired when the deadline from arrived_at (loop time) passes first.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = (loop.time() if arrived_at is None else arrived_at) + self.deadline
+        if loop.time() >= deadline:
+            self.expired += 1
+            raise QueryExpired()
+        full = await self._acquire(user_id, min(deadline, loop.time() + self.max_wait))
+        timeout = asyncio.timeout_at(deadline)
+        try:
+            async with timeout:
+                yield full
+        except TimeoutError:
+            # Timeouts of upstream requests are not ours to relabel
+            if not timeout.expired():
+                raise
+            self.expired += 1
+            raise QueryExpired() from None
+        finally:
+            if full:
+                self._release(user_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'running': self._running,
+            'waiting': len(self._waiters),
+            'admitted': self.admitted,
+            'waited': self.waited,
+            'degraded': self.degraded,
+            'expired': self.expired,
+        }
+
+
+inline_admission = InlineAdmission()
@@ -0,0 +1,157 @@
+import asyncio
+import copy
+import os
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from loguru import logger
+from yandex_music import Track
+
+from ..cache import TTLCache
+
+# Upper bound of download-info resolutions running at once across all queries
+RESOLVE_CONCURRENCY = int(os.getenv("RESOLVE_CONCURRENCY", "24"))
+# A track that takes longer than this to resolve is dropped from the answer
+RESOLVE_TRACK_TIMEOUT = float(os.getenv("RESOLVE_TRACK_TIMEOUT", "4"))
+
+# Direct links are reused for this long unless the link carries its own expiry
+DIRECT_LINK_TTL = float(os.getenv("DIRECT_LINK_TTL", "300"))
+DIRECT_LINK_CACHE_SIZE = int(os.getenv("DIRECT_LINK_CACHE_SIZE", "50000"))
+# Links requested at least this many times per refresh interval are refreshed before they expire
+DIRECT_LINK_HOT_HITS = int(os.getenv("DIRECT_LINK_HOT_HITS", "3"))
+DIRECT_LINK_REFRESH_INTERVAL = float(os.getenv("DIRECT_LINK_REFRESH_INTERVAL", "30"))
+# How long to remember that a track has no download variant for a bitrate
+MISSING_BITRATE_TTL = float(os.getenv("MISSING_BITRATE_TTL", "86400"))
+
+# Bitrates tried in order of preference
+MP3_BITRATES = (320, 192)
+
+LinkKey = Tuple[str, str, int]
+
+_resolve_semaphore = asyncio.Semaphore(RESOLVE_CONCURRENCY)
+
+# Resolved direct links keyed by (track id, codec, bitrate)
+link_cache: TTLCache[str] = TTLCache(maxsize=DIRECT_LINK_CACHE_SIZE, ttl=DIRECT_LINK_TTL)
+# (track id, codec, bitrate) variants that don't exist, so they are not probed again
+missing_bitrates: TTLCache[bool] = TTLCache(maxsize=DIRECT_LINK_CACHE_SIZE, ttl=MISSING_BITRATE_TTL)
+
+
+def link_ttl(url: str) -> float:
+    """Seconds a direct link may be reused: its own expiry if it has one, DIRECT_LINK_TTL otherwise."""
+    params = parse_qs(urlparse(url).query)
+    for name in ('expires', 'exp'):
+        if name in params:
+            try:
+                remaining = float(params[name][0]) - time.time()
+            except ValueError:
+                continue
+            # Leave a margin so Telegram still gets a valid link when it fetches it
+            return max(0.0, min(remaining - 30, DIRECT_LINK_TTL))
+    return DIRECT_LINK_TTL
+
+
+class HotLinks:
+    """Counts link cache hits and refreshes popular links before they expire."""
+
+    def __init__(self, refresh_interval: float = DIRECT_LINK_REFRESH_INTERVAL, hot_hits: int = DIRECT_LINK_HOT_HITS):
+        self.refresh_interval = refresh_interval
+        self.hot_hits = hot_hits
+        self._hits: Dict[LinkKey, int] = {}
+        self._tracks: Dict[LinkKey, Track] = {}
+        self.refreshed = 0
+
+    def hit(self, key: LinkKey, track: Track) -> None:
+        self._hits[key] = self._hits.get(key, 0) + 1
+        self._tracks[key] = track
+
+    async def refresh(self) -> None:
+        hits, tracks = self._hits, self._tracks
+        self._hits, self._tracks = {}, {}
+        for key, count in hits.items():
+            if count < self.hot_hits:
+                continue
+            remaining = link_cache.expires_in(key)
+            if remaining is not None and remaining > self.refresh_interval * 2:
+                continue
+            track = copy.copy(tracks[key])
+            track.download_info = None
+            try:
+                async with _resolve_semaphore:
+                    await resolve_direct_link(track, use_cache=False)
+                self.refreshed += 1
+            except Exception as e:
+                logger.warning(f"Failed to refresh direct link for track {key[0]}: {e}")
+
+    async def run(self) -> None:
+        """Background task refreshing hot links."""
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Error refreshing direct links: {e}")
+
+
+hot_links = HotLinks()
+
+
+def cached_direct_link(track_id: str) -> Optional[str]:
+    """The cached direct link of the best bitrate known for the track, without any request."""
+    for bitrate in MP3_BITRATES:
+        key = (track_id, 'mp3', bitrate)
+        # Membership checks, so probing doesn't count as cache lookups
+        if key in missing_bitrates:
+            continue
+        if key in link_cache:
+            return link_cache.get(key)
+    return None
+
+
+async def resolve_direct_link(track: Track, use_cache: bool = True) -> Optional[str]:
+    """Get a direct mp3 link for the track in the best available bitrate.
+
+    With use_cache=False cached links are not read, but the fresh link is still stored.
+    """
+    track_id = str(track.id)
+    for bitrate in MP3_BITRATES:
+        key = (track_id, 'mp3', bitrate)
+        if missing_bitrates.get(key):
+            continue
+        if use_cache:
+            url = link_cache.get(key)
+            if url is not None:
+                hot_links.hit(key, track)
+                return url
+
+        dlinfo = await track.get_specific_download_info_async(codec='mp3', bitrate_in_kbps=bitrate)
+        if dlinfo is None:
+            missing_bitrates.set(key, True)
+            continue
+        # download info requested with get_direct_links=True already carries the link
+        url = dlinfo.direct_link or await dlinfo.get_direct_link_async()
+        link_cache.set(key, url, ttl=link_ttl(url))
+        return url
+    return None
+
+
+async def _resolve_bounded(track: Track, timeout: float) -> Optional[str]:
+    async def resolve():
+        async with _resolve_semaphore:
+            return await resolve_direct_link(track)
+
+    try:
+        return await asyncio.wait_for(resolve(), timeout=timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"Resolving track {track.id} took longer than {timeout}s, dropping it")
+    except Exception as e:
+        logger.warning(f"Failed to resolve track {track.id}: {e}")
+    return None
+
+
+async def resolve_direct_links(tracks: Sequence[Track], timeout: float = RESOLVE_TRACK_TIMEOUT) -> List[Optional[str]]:
+    """Resolve direct links for several tracks concurrently.
+
+    The result keeps the order of tracks. Tracks that fail or miss the deadline get None.
+    """
+    return await asyncio.gather(*(_resolve_bounded(track, timeout) for track in tracks))
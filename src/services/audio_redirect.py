@@ -0,0 +1,115 @@
+import hashlib
+import hmac
+import os
+import time
+from typing import Any, Dict, Optional
+
+from aiohttp import web
+from loguru import logger
+from yandex_music import Track
+
+from ..database.user_operations import get_user
+from .audio import cached_direct_link, resolve_direct_link
+from .metrics import Counter, Histogram
+from .yandex_clients import client_pool
+
+# Public base URL of the redirect endpoint, e.g. https://audio.example.com. Disabled when unset.
+AUDIO_REDIRECT_URL = os.getenv("AUDIO_REDIRECT_URL", "").rstrip('/')
+AUDIO_REDIRECT_HOST = os.getenv("AUDIO_REDIRECT_HOST", "0.0.0.0")
+AUDIO_REDIRECT_PORT = int(os.getenv("AUDIO_REDIRECT_PORT", "8081"))
+# Signs the URLs so the endpoint can't be used to fetch arbitrary tracks; derived from BOT_TOKEN when unset
+AUDIO_REDIRECT_SECRET = os.getenv("AUDIO_REDIRECT_SECRET") or hashlib.sha256(
+    f"audio-redirect:{os.getenv('BOT_TOKEN', '')}".encode()).hexdigest()
+
+audio_redirects_total = Counter(
+    'ymbot_audio_redirects_total', 'Requests to the audio redirect endpoint by outcome', ['outcome'])
+audio_redirect_seconds = Histogram(
+    'ymbot_audio_redirect_seconds', 'Time to answer the audio redirect endpoint', ['outcome'])
+
+
+class AudioRedirects:
+    """Hands Telegram stable /a/<track_id> URLs and resolves the direct link only when one is fetched.
+
+    Inline answers then don't wait for download info at all, and links are resolved
+    only for the tracks users actually send. A fetch is answered with a 302 to the
+    best bitrate, from the direct link cache when possible. A personal URL carries the
+    id of the user it was served to, whose token resolves the link, so any process can
+    answer it. Shared URLs, for answers Telegram may show to other users, carry no user
+    and are resolved with DEFAULT_YM_TOKEN.
+    """
+
+    def __init__(self, base_url: str = AUDIO_REDIRECT_URL, secret: str = AUDIO_REDIRECT_SECRET):
+        self.base_url = base_url
+        self._secret = secret.encode()
+        self.redirects = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.base_url)
+
+    def _sign(self, track_id: str, user_id: str) -> str:
+        return hmac.new(self._secret, f'{track_id}:{user_id}'.encode(), hashlib.sha256).hexdigest()[:32]
+
+    @property
+    def shared(self) -> bool:
+        """Whether shared URLs can be resolved, i.e. DEFAULT_YM_TOKEN is set."""
+        return bool(os.getenv('DEFAULT_YM_TOKEN'))
+
+    def url(self, track_id: str, user_id: Optional[int] = None) -> str:
+        """Stable URL of the track's audio as served to the user, or a shared one without user_id."""
+        if user_id is None:
+            return f'{self.base_url}/a/{track_id}?s={self._sign(track_id, "")}'
+        return f'{self.base_url}/a/{track_id}?u={user_id}&s={self._sign(track_id, str(user_id))}'
+
+    async def _resolve(self, track_id: str, user_id: str) -> Optional[str]:
+        # Read past the user cache: /token and /reset handled by another worker only update theirs
+        user = await get_user(int(user_id), use_cache=False) if user_id.isdigit() else None
+        token = (user.ym_token if user else None) or os.getenv('DEFAULT_YM_TOKEN')
+        if not token:
+            return None
+        client = await client_pool.get(token)
+        return await resolve_direct_link(Track(id=track_id, client=client))
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        started = time.perf_counter()
+        track_id = request.match_info['track_id']
+        user_id = request.query.get('u', '')
+        url = None
+        if not hmac.compare_digest(request.query.get('s', ''), self._sign(track_id, user_id)):
+            outcome = 'forbidden'
+        else:
+            url = cached_direct_link(track_id)
+            outcome = 'cached'
+            if url is None:
+                try:
+                    url = await self._resolve(track_id, user_id)
+                    outcome = 'resolved' if url else 'not_found'
+                except Exception as e:
+                    logger.warning(f"Failed to resolve audio of track {track_id}: {e}")
+                    outcome = 'error'
+        audio_redirects_total.inc(outcome=outcome)
+        audio_redirect_seconds.observe(time.perf_counter() - started, outcome=outcome)
+
+        if url:
+            self.redirects += 1
+            raise web.HTTPFound(url)
+        if outcome == 'forbidden':
+            raise web.HTTPForbidden()
+        if outcome == 'error':
+            raise web.HTTPBadGateway()
+        raise web.HTTPNotFound()
+
+    async def serve(self, host: str = AUDIO_REDIRECT_HOST, port: int = AUDIO_REDIRECT_PORT) -> web.AppRunner:
+        """Start the endpoint. The returned runner is cleaned up on shutdown."""
+        app = web.Application()
+        app.router.add_get('/a/{track_id}', self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+    def stats(self) -> Dict[str, Any]:
+        return {'enabled': self.enabled, 'redirects': self.redirects}
+
+
+audio_redirects = AudioRedirects()
@@ -0,0 +1,193 @@
+import asyncio
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from loguru import logger
+
+from ..database.broadcast_operations import finish_broadcast, save_broadcast_progress
+from ..database.user_operations import iter_user_id_batches
+from ..models.broadcast import Broadcast
+
+# Telegram allows about 30 messages per second in total; every user gets one message, so the per-chat limit is never hit
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_MIN_RATE = float(os.getenv("BROADCAST_MIN_RATE", "1"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "30"))
+# Users read from the database and checkpointed at a time
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", "500"))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+BROADCAST_REPORT_INTERVAL = float(os.getenv("BROADCAST_REPORT_INTERVAL", "5"))
+
+
+class TokenBucket:
+    """Rate limiter handing out rate tokens per second, with bursts of up to capacity."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        # Waiters are served in order; the one holding the lock sleeps until its token is available
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float, slow_down: float = 1.0, min_rate: float = BROADCAST_MIN_RATE) -> None:
+        """Hand out no tokens for the given time, e.g. after a flood-control error.
+
+        The rate is multiplied by slow_down once per pause, not for every request that hit it.
+        """
+        now = time.monotonic()
+        if now >= self._paused_until:
+            self.rate = max(min_rate, self.rate * slow_down)
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._tokens = 0
+
+
+@dataclass
+class BroadcastProgress:
+    broadcast_id: int
+    total: int
+    sent: int = 0
+    failed: int = 0
+    blocked: int = 0
+    retries: int = 0
+    # Current rate of the token bucket
+    rate_limit: float = BROADCAST_RATE
+    done: bool = False
+    started_at: float = field(default_factory=time.monotonic)
+    # Already processed when this run started, i.e. before a resume
+    resumed_from: int = 0
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.failed + self.blocked
+
+    @property
+    def throughput(self) -> float:
+        """Messages per second since this run started."""
+        elapsed = time.monotonic() - self.started_at
+        return (self.processed - self.resumed_from) / elapsed if elapsed > 0 else 0.0
+
+
+class BroadcastEngine:
+    """Sends a broadcast to every user, streaming user ids from the database in batches.
+
+    Sending is concurrent but limited by a token bucket. Flood-control errors pause the
+    bucket for retry_after and lower its rate, which then recovers after clean batches.
+    Progress is saved after every batch, so an interrupted broadcast resumes from there;
+    at most one batch is sent again.
+    """
+
+    def __init__(self, rate: float = BROADCAST_RATE, concurrency: int = BROADCAST_CONCURRENCY,
+                 batch_size: int = BROADCAST_BATCH_SIZE, max_retries: int = BROADCAST_MAX_RETRIES):
+        self.rate = rate
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.progress: Optional[BroadcastProgress] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self, bot: Bot, broadcast: Broadcast, total: int,
+              report: Callable[[BroadcastProgress], Awaitable[None]]) -> None:
+        """Run the broadcast in a background task."""
+        self._task = asyncio.create_task(self.run(bot, broadcast, total, report))
+
+    async def stop(self) -> None:
+        """Cancel a running broadcast. Its progress stays saved, so it is resumed on the next start."""
+        if self.running:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def run(self, bot: Bot, broadcast: Broadcast, total: int,
+                  report: Callable[[BroadcastProgress], Awaitable[None]]) -> BroadcastProgress:
+        progress = BroadcastProgress(
+            broadcast_id=broadcast.id,
+            total=total,
+            sent=broadcast.sent,
+            failed=broadcast.failed,
+            blocked=broadcast.blocked,
+            rate_limit=self.rate,
+        )
+        progress.resumed_from = progress.processed
+        self.progress = progress
+        bucket = TokenBucket(self.rate)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        last_report = time.monotonic()
+
+        async def send(user_id: int) -> None:
+            async with semaphore:
+                await self._send(bot, bucket, user_id, broadcast.text, progress)
+
+        try:
+            async for batch in iter_user_id_batches(broadcast.last_user_id, self.batch_size):
+                retries = progress.retries
+                await asyncio.gather(*(send(user_id) for user_id in batch))
+                if progress.retries == retries:
+                    # No flood control in this batch, speed back up
+                    bucket.rate = min(self.rate, bucket.rate * 1.1)
+                progress.rate_limit = bucket.rate
+                await save_broadcast_progress(
+                    broadcast.id, batch[-1], progress.sent, progress.failed, progress.blocked
+                )
+                if time.monotonic() - last_report >= BROADCAST_REPORT_INTERVAL:
+                    last_report = time.monotonic()
+                    await self._report(report, progress)
+            await finish_broadcast(broadcast.id)
+            progress.done = True
+        finally:
+            await self._report(report, progress)
+        return progress
+
+    async def _send(self, bot: Bot, bucket: TokenBucket, user_id: int, text: str, progress: BroadcastProgress) -> None:
+        for _ in range(self.max_retries + 1):
+            await bucket.acquire()
+            try:
+                await bot.send_message(user_id, text, parse_mode='HTML')
+                progress.sent += 1
+                return
+            except TelegramRetryAfter as e:
+                progress.retries += 1
+                bucket.pause(e.retry_after, slow_down=0.8)
+            except TelegramForbiddenError:
+                # The user has blocked the bot or deleted the account
+                progress.blocked += 1
+                return
+            except Exception as e:
+                logger.debug(f"Failed to send broadcast to {user_id}: {e}")
+                progress.failed += 1
+                return
+        progress.failed += 1
+
+    @staticmethod
+    async def _report(report: Callable[[BroadcastProgress], Awaitable[None]], progress: BroadcastProgress) -> None:
+        try:
+            await report(progress)
+        except Exception as e:
+            logger.warning(f"Failed to report broadcast progress: {e}")
+
+
+broadcast_engine = BroadcastEngine()
@@ -0,0 +1,83 @@
+import os
+from typing import Any, Dict, Optional
+
+import aiohttp
+from aiogram.client.session.aiohttp import AiohttpSession
+
+from .metrics import upstream_call
+
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "300"))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "100"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+
+
+class HttpPool:
+    """An aiohttp session and connector for outbound traffic.
+
+    http_pool is shared by all short request/response traffic. A long-lived websocket
+    keeps its connection slot for as long as it is open, so warm websockets use a pool
+    of their own and can't starve API requests.
+    """
+
+    def __init__(self, limit: int = HTTP_POOL_LIMIT, limit_per_host: int = HTTP_POOL_LIMIT_PER_HOST):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._connector: Optional[aiohttp.TCPConnector] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """The shared session, created on first use inside the running event loop."""
+        if self._session is None or self._session.closed:
+            self._connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+                use_dns_cache=True,
+                ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            )
+            # Callers pass per-request timeouts, long-lived websockets must not hit a total timeout
+            timeout = aiohttp.ClientTimeout(total=None, connect=HTTP_CONNECT_TIMEOUT)
+            self._session = aiohttp.ClientSession(connector=self._connector, timeout=timeout)
+        return self._session
+
+    def stats(self) -> Dict[str, Any]:
+        connector = self._connector
+        if connector is None or connector.closed:
+            return {'limit': self.limit, 'limit_per_host': self.limit_per_host,
+                    'in_use': 0, 'idle': 0, 'hosts': {}}
+        acquired_per_host = getattr(connector, '_acquired_per_host', {})
+        idle = getattr(connector, '_conns', {})
+        return {
+            'limit': connector.limit,
+            'limit_per_host': connector.limit_per_host,
+            'in_use': len(getattr(connector, '_acquired', ())),
+            'idle': sum(len(conns) for conns in idle.values()),
+            'hosts': {key.host: len(conns) for key, conns in acquired_per_host.items() if conns},
+        }
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._connector = None
+
+
+http_pool = HttpPool()
+
+
+class SharedAiohttpSession(AiohttpSession):
+    """aiogram session that sends Telegram API requests through the shared HttpPool."""
+
+    async def create_session(self) -> aiohttp.ClientSession:
+        return http_pool.session
+
+    async def make_request(self, bot, method, timeout=None):
+        with upstream_call('telegram'):
+            return await super().make_request(bot, method, timeout)
+
+    async def close(self) -> None:
+        # The shared session is closed by http_pool.close() when the bot stops
+        pass
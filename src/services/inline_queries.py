@@ -0,0 +1,57 @@
+import asyncio
+import os
+from typing import Any, Dict
+
+# Pause before a search goes upstream; a newer query from the same user within it cancels the search
+INLINE_DEBOUNCE = float(os.getenv("INLINE_DEBOUNCE", "0.35"))
+
+
+class InlineQueryTracker:
+    """Keeps at most one inline query in flight per user.
+
+    Telegram sends a query for almost every keystroke. When a newer query from the
+    same user arrives, the handler task of the older one is cancelled, so it stops
+    wherever it is instead of finishing searches and resolutions nobody will see.
+    """
+
+    def __init__(self, debounce: float = INLINE_DEBOUNCE):
+        self.debounce = debounce
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self.queries = 0
+        self.superseded = 0
+        self.searches_saved = 0
+
+    def start(self, user_id: int) -> None:
+        """Register the current task as the user's query, cancelling the previous one."""
+        self.queries += 1
+        task = asyncio.current_task()
+        previous = self._tasks.get(user_id)
+        if previous is not None and previous is not task and not previous.done():
+            previous.cancel()
+            self.superseded += 1
+        self._tasks[user_id] = task
+
+    def finish(self, user_id: int) -> None:
+        if self._tasks.get(user_id) is asyncio.current_task():
+            del self._tasks[user_id]
+
+    async def wait(self) -> None:
+        """Debounce window before an upstream search. Raises CancelledError if superseded."""
+        if self.debounce <= 0:
+            return
+        try:
+            await asyncio.sleep(self.debounce)
+        except asyncio.CancelledError:
+            self.searches_saved += 1
+            raise
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'in_flight': len(self._tasks),
+            'queries': self.queries,
+            'superseded': self.superseded,
+            'searches_saved': self.searches_saved,
+        }
+
+
+inline_tracker = InlineQueryTracker()
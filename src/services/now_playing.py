@@ -0,0 +1,248 @@
+import asyncio
+import heapq
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from loguru import logger
+from yandex_music import Track
+
+from .audio import link_ttl
+from .ynison import ynison_manager
+
+# Keep now-playing results of recently active token holders prepared in the background
+NOW_PLAYING_PREFETCH = os.getenv("NOW_PLAYING_PREFETCH", "1") == "1"
+# A user stays active, and their result cached, this long after their last now-playing query
+NOW_PLAYING_ACTIVE_WINDOW = float(os.getenv("NOW_PLAYING_ACTIVE_WINDOW", "600"))
+# How long the result of a paused track stays valid; resuming the same track doesn't change it
+NOW_PLAYING_PAUSED_TTL = float(os.getenv("NOW_PLAYING_PAUSED_TTL", "60"))
+# A result this close to expiry is still served, but recomputed in the background
+NOW_PLAYING_REVALIDATE_BEFORE = float(os.getenv("NOW_PLAYING_REVALIDATE_BEFORE", "10"))
+# Upper bound of the Telegram cache_time of now-playing answers; skips can't reach Telegram's cache
+NOW_PLAYING_MAX_CACHE_TIME = int(os.getenv("NOW_PLAYING_MAX_CACHE_TIME", "30"))
+# Bounds of the refresh interval; within them a result is refreshed when its track should end
+NOW_PLAYING_MIN_INTERVAL = float(os.getenv("NOW_PLAYING_MIN_INTERVAL", "5"))
+NOW_PLAYING_MAX_INTERVAL = float(os.getenv("NOW_PLAYING_MAX_INTERVAL", "60"))
+NOW_PLAYING_CONCURRENCY = int(os.getenv("NOW_PLAYING_CONCURRENCY", "20"))
+NOW_PLAYING_MAX_USERS = int(os.getenv("NOW_PLAYING_MAX_USERS", "2000"))
+
+
+@dataclass
+class NowPlaying:
+    """Everything needed to answer an empty inline query."""
+    track: Track
+    # Id of the track in the Ynison queue
+    playable_id: str
+    file_id: Optional[str]
+    url: Optional[str]
+    paused: bool
+    duration_ms: int
+    progress_ms: int
+    # Monotonic time progress_ms refers to
+    computed_at: float
+
+    def remaining(self) -> float:
+        """Seconds until the track should end, assuming it keeps playing."""
+        remaining = max(0, self.duration_ms - self.progress_ms) / 1000
+        if not self.paused:
+            remaining -= time.monotonic() - self.computed_at
+        return max(0.0, remaining)
+
+
+class NowPlayingCache:
+    """Per-user now-playing results, valid while the track they show should still be playing.
+
+    An empty inline query otherwise waits for Ynison, track info and download info. A
+    result stays valid for the remaining time of its track, or NOW_PLAYING_PAUSED_TTL
+    while paused, and not longer than its direct link. A skip shows up in the warm Ynison
+    state and invalidates it at once. Results close to expiry are still served while
+    they are recomputed in the background.
+
+    With prefetch on, results of users who asked within the active window are also
+    refreshed in the background shortly after their track should end, so the next
+    query finds a fresh one.
+    """
+
+    def __init__(self, prefetch: bool = NOW_PLAYING_PREFETCH, active_window: float = NOW_PLAYING_ACTIVE_WINDOW,
+                 paused_ttl: float = NOW_PLAYING_PAUSED_TTL, revalidate_before: float = NOW_PLAYING_REVALIDATE_BEFORE,
+                 min_interval: float = NOW_PLAYING_MIN_INTERVAL, max_interval: float = NOW_PLAYING_MAX_INTERVAL,
+                 concurrency: int = NOW_PLAYING_CONCURRENCY, max_users: int = NOW_PLAYING_MAX_USERS):
+        self.prefetch = prefetch
+        self.active_window = active_window
+        self.paused_ttl = paused_ttl
+        self.revalidate_before = revalidate_before
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_users = max_users
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._compute: Optional[Callable[[str], Awaitable[Optional[NowPlaying]]]] = None
+        # token -> monotonic time of the last query, oldest first
+        self._active: Dict[str, float] = {}
+        # token -> result and the monotonic time it stops being valid
+        self._results: Dict[str, Tuple[NowPlaying, float]] = {}
+        self._due: List[Tuple[float, str]] = []
+        self._next_refresh: Dict[str, float] = {}
+        self._refreshing: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.refreshes = 0
+        self.failures = 0
+
+    def get(self, token: str) -> Optional[NowPlaying]:
+        """The token's result if it is still valid. Marks the user active.
+
+        A result close to expiry is revalidated in the background.
+        """
+        self._touch(token)
+        entry = self._results.get(token)
+        if entry is None or not self._valid(token, *entry):
+            self.misses += 1
+            return None
+        self.hits += 1
+        if entry[1] - time.monotonic() < self.revalidate_before and token not in self._refreshing:
+            self.revalidations += 1
+            self._start_refresh(token)
+        return entry[0]
+
+    def put(self, token: str, result: NowPlaying) -> None:
+        """Store a freshly computed result and, with prefetch on, schedule its refresh."""
+        if token not in self._active:
+            return
+        valid_for = self.paused_ttl if result.paused else result.remaining()
+        if result.url:
+            # The answer must not hand out an expired link
+            valid_for = min(valid_for, link_ttl(result.url))
+        # A track extrapolated past its end, e.g. the app was closed without pausing, would
+        # otherwise be recomputed on every tick
+        valid_for = max(valid_for, self.min_interval)
+        self._results[token] = (result, time.monotonic() + valid_for)
+        if self.prefetch:
+            # Refresh shortly after the track should have ended
+            self._schedule(token, min(max(valid_for + 1, self.min_interval), self.max_interval))
+
+    def cache_time(self, token: str) -> int:
+        """Seconds Telegram may cache the token's now-playing answer: the time its result stays valid."""
+        entry = self._results.get(token)
+        if entry is None:
+            return 0
+        return max(0, min(int(entry[1] - time.monotonic()), NOW_PLAYING_MAX_CACHE_TIME))
+
+    def forget(self, token: Optional[str]) -> None:
+        """Drop everything about a revoked or replaced token."""
+        if token:
+            self._active.pop(token, None)
+            self._results.pop(token, None)
+            self._next_refresh.pop(token, None)
+            self._compact()
+
+    def _touch(self, token: str) -> None:
+        self._active.pop(token, None)
+        self._active[token] = time.monotonic()
+        if len(self._active) > self.max_users:
+            self.forget(next(iter(self._active)))
+
+    def _valid(self, token: str, result: NowPlaying, expires_at: float) -> bool:
+        if expires_at <= time.monotonic():
+            return False
+        # The warm Ynison connection shows skips as soon as they happen
+        current = ynison_manager.current_playable_id(token)
+        return current is None or current == result.playable_id
+
+    def _schedule(self, token: str, delay: float) -> None:
+        due = time.monotonic() + delay
+        self._next_refresh[token] = due
+        heapq.heappush(self._due, (due, token))
+        self._compact()
+
+    def _compact(self) -> None:
+        """Rebuild the refresh heap once replaced and forgotten entries outnumber the live ones."""
+        if len(self._due) > 2 * len(self._next_refresh) + 64:
+            self._due = [(due, token) for token, due in self._next_refresh.items()]
+            heapq.heapify(self._due)
+
+    def _start_refresh(self, token: str) -> None:
+        if self._compute is None:
+            return
+        self._refreshing.add(token)
+        task = asyncio.create_task(self._refresh(token, self._compute))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _refresh(self, token: str, compute: Callable[[str], Awaitable[Optional[NowPlaying]]]) -> None:
+        try:
+            async with self._semaphore:
+                result = await compute(token)
+        except Exception as e:
+            self.failures += 1
+            logger.warning(f"Failed to refresh the current track: {e}")
+            result = None
+        finally:
+            self._refreshing.discard(token)
+        if token not in self._active:
+            return
+        self.refreshes += 1
+        if result is not None:
+            self.put(token, result)
+            return
+        self._results.pop(token, None)
+        if self.prefetch:
+            self._schedule(token, self.max_interval)
+
+    def _collect(self) -> List[str]:
+        """Tokens whose result should be refreshed now. Forgets users that are no longer active."""
+        now = time.monotonic()
+        while self._active:
+            token, last_seen = next(iter(self._active.items()))
+            if last_seen > now - self.active_window:
+                break
+            self.forget(token)
+        if not self.prefetch:
+            return []
+
+        tokens: List[str] = []
+        for token, entry in self._results.items():
+            if token not in self._refreshing and not self._valid(token, *entry):
+                tokens.append(token)
+        while self._due and self._due[0][0] <= now:
+            due, token = heapq.heappop(self._due)
+            # Entries replaced by a later schedule are skipped
+            if self._next_refresh.get(token) == due and token not in self._refreshing and token not in tokens:
+                tokens.append(token)
+        for token in tokens:
+            self._next_refresh.pop(token, None)
+        return tokens
+
+    async def run(self, compute: Callable[[str], Awaitable[Optional[NowPlaying]]], tick: float = 1.0) -> None:
+        """Background task computing results with compute(token): revalidations, prefetch and expiry."""
+        self._compute = compute
+        try:
+            while True:
+                await asyncio.sleep(tick)
+                try:
+                    for token in self._collect():
+                        self._start_refresh(token)
+                except Exception as e:
+                    logger.error(f"Error scheduling now-playing refreshes: {e}")
+        finally:
+            self._compute = None
+            for task in self._tasks:
+                task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'prefetch': self.prefetch,
+            'active': len(self._active),
+            'results': len(self._results),
+            'refreshing': len(self._refreshing),
+            'hits': self.hits,
+            'misses': self.misses,
+            'revalidations': self.revalidations,
+            'refreshes': self.refreshes,
+            'failures': self.failures,
+        }
+
+
+now_playing_cache = NowPlayingCache()
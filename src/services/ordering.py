@@ -0,0 +1,48 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+
+class UserOrderingMiddleware(BaseMiddleware):
+    """Keeps a user's messages in order with each other and with their later inline queries.
+
+    Updates are handled as concurrent tasks, so without this an inline query sent right
+    after /token could be answered with the old token. Messages from one user run one at
+    a time, in arrival order. Inline queries wait for the user's pending messages but not
+    for each other, so a newer query can still cancel an older one.
+    """
+
+    def __init__(self):
+        self._locks: Dict[int, asyncio.Lock] = {}
+        # Messages holding or waiting for each lock, so idle locks can be dropped
+        self._waiting: Dict[int, int] = {}
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get('event_from_user')
+        if user is None:
+            return await handler(event, data)
+
+        if event.message is not None:
+            lock = self._locks.setdefault(user.id, asyncio.Lock())
+            self._waiting[user.id] = self._waiting.get(user.id, 0) + 1
+            try:
+                async with lock:
+                    return await handler(event, data)
+            finally:
+                self._waiting[user.id] -= 1
+                if not self._waiting[user.id]:
+                    del self._waiting[user.id]
+                    del self._locks[user.id]
+
+        lock = self._locks.get(user.id)
+        if lock is not None:
+            async with lock:
+                pass
+        return await handler(event, data)
@@ -0,0 +1,200 @@
+import asyncio
+import heapq
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from loguru import logger
+
+from ..database.chosen_result_operations import (
+    ChosenKey, add_chosen_results, delete_chosen_results_before, get_top_queries, get_top_tracks,
+)
+from ..database.track_file_operations import get_file_ids
+from .audio import resolve_direct_links
+from .search import normalize_query, search_cache, search_tracks
+from .uploads import ServedTrack, audio_uploader
+from .yandex_clients import client_pool
+
+# How often chosen result counts are written to the database
+CHOSEN_FLUSH_INTERVAL = float(os.getenv("CHOSEN_FLUSH_INTERVAL", "30"))
+# Daily rows older than this are deleted
+CHOSEN_RETENTION_DAYS = int(os.getenv("CHOSEN_RETENTION_DAYS", "30"))
+# How many of the most sent tracks and queries are kept warm, and how often
+POPULARITY_TOP_N = int(os.getenv("POPULARITY_TOP_N", "50"))
+POPULARITY_WARM_INTERVAL = float(os.getenv("POPULARITY_WARM_INTERVAL", "300"))
+# Popularity halves after this many seconds without new sends
+POPULARITY_HALF_LIFE = float(os.getenv("POPULARITY_HALF_LIFE", "3600"))
+# Days of stored counts the top lists start from after a restart
+POPULARITY_SEED_DAYS = int(os.getenv("POPULARITY_SEED_DAYS", "1"))
+
+MAX_QUERY_LENGTH = 128
+
+
+def _today() -> datetime:
+    return datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _top(scores: Dict[str, float], count: int) -> List[str]:
+    return heapq.nlargest(count, scores, key=scores.__getitem__)
+
+
+class PopularityTracker:
+    """Learns from chosen inline results which tracks and queries users actually send.
+
+    Every chosen result is counted in memory. The counts are flushed to the
+    chosen_result table in batches and feed decaying scores for a rolling top-N of
+    tracks and queries. The top entries are kept warm: their searches stay in
+    search_cache, their file_ids in memory, and tracks not stored in Telegram yet get
+    a fresh direct link and are queued for upload.
+
+    The caches warmed are shared by all users, so warming uses DEFAULT_YM_TOKEN only
+    and is skipped without it; users' own tokens are never spent on shared work.
+
+    Telegram only sends chosen results when inline feedback is enabled in @BotFather.
+    """
+
+    def __init__(self, top_n: int = POPULARITY_TOP_N, warm_interval: float = POPULARITY_WARM_INTERVAL,
+                 half_life: float = POPULARITY_HALF_LIFE, flush_interval: float = CHOSEN_FLUSH_INTERVAL):
+        self.top_n = top_n
+        self.warm_interval = warm_interval
+        self.half_life = half_life
+        self.flush_interval = flush_interval
+        self._pending: Dict[ChosenKey, int] = {}
+        self._track_scores: Dict[str, float] = {}
+        self._query_scores: Dict[str, float] = {}
+        self._lock = asyncio.Lock()
+        self._last_cleanup: Optional[datetime] = None
+        self.chosen = 0
+        self.warmed_searches = 0
+        self.warmed_links = 0
+        self.queued_uploads = 0
+
+    def record(self, kind: str, track_id: str, query: str) -> None:
+        """Count a chosen result; query is the text it was found with, '' for now playing."""
+        query = normalize_query(query)[:MAX_QUERY_LENGTH] if kind == 'search' else ''
+        key = (kind, track_id, query)
+        self._pending[key] = self._pending.get(key, 0) + 1
+        self._track_scores[track_id] = self._track_scores.get(track_id, 0) + 1
+        if query:
+            self._query_scores[query] = self._query_scores.get(query, 0) + 1
+        self.chosen += 1
+
+    def top_tracks(self, count: Optional[int] = None) -> List[str]:
+        return _top(self._track_scores, count or self.top_n)
+
+    def top_queries(self, count: Optional[int] = None) -> List[str]:
+        return _top(self._query_scores, count or self.top_n)
+
+    async def flush(self) -> None:
+        """Write pending counts to the database in one batch."""
+        async with self._lock:
+            counts, self._pending = self._pending, {}
+            if not counts:
+                return
+            try:
+                await add_chosen_results(_today(), counts)
+            except Exception:
+                # Put the counts back so they are retried on the next flush
+                for key, value in counts.items():
+                    self._pending[key] = self._pending.get(key, 0) + value
+                raise
+
+    async def load(self, days: int = POPULARITY_SEED_DAYS) -> None:
+        """Start the scores from the counts stored for the last days."""
+        since = _today() - timedelta(days=days)
+        for track_id, count in await get_top_tracks(since, self.top_n * 2):
+            self._track_scores[track_id] = self._track_scores.get(track_id, 0) + count
+        for query, count in await get_top_queries(since, self.top_n * 2):
+            self._query_scores[query] = self._query_scores.get(query, 0) + count
+
+    def decay(self, elapsed: float) -> None:
+        """Age the scores, dropping entries that no longer matter."""
+        factor = 0.5 ** (elapsed / self.half_life)
+        for scores in (self._track_scores, self._query_scores):
+            keep = set(_top(scores, self.top_n * 4))
+            for key in list(scores):
+                scores[key] *= factor
+                if key not in keep or scores[key] < 0.1:
+                    del scores[key]
+
+    async def _client(self):
+        token = os.getenv('DEFAULT_YM_TOKEN')
+        return await client_pool.get(token) if token else None
+
+    async def warm_searches(self) -> None:
+        client = None
+        for query in self.top_queries():
+            remaining = search_cache.expires_in(query)
+            if remaining is not None and remaining > self.warm_interval * 2:
+                continue
+            client = client or await self._client()
+            if client is None:
+                return
+            await search_tracks(client, query, use_cache=False)
+            self.warmed_searches += 1
+
+    async def warm_tracks(self) -> None:
+        track_ids = self.top_tracks()
+        if not track_ids:
+            return
+        # Loads the file_ids of popular tracks into memory
+        file_ids = await get_file_ids(track_ids)
+        missing = [track_id for track_id in track_ids if track_id not in file_ids]
+        if not missing:
+            return
+        client = await self._client()
+        if client is None:
+            return
+        tracks = await client.tracks(missing)
+        for track, url in zip(tracks, await resolve_direct_links(tracks)):
+            if not url:
+                continue
+            self.warmed_links += 1
+            artists = ', '.join(artist.name for artist in track.artists) if track.artists else ''
+            served = ServedTrack(url, track.title or '', artists, (track.duration_ms or 0) // 1000)
+            if audio_uploader.enqueue(str(track.id), served):
+                self.queued_uploads += 1
+
+    async def warm(self) -> None:
+        self.decay(self.warm_interval)
+        for warm in (self.warm_searches, self.warm_tracks):
+            try:
+                await warm()
+            except Exception as e:
+                logger.warning(f"Error warming popular results: {e}")
+
+    async def run(self) -> None:
+        """Background task flushing counts, cleaning up old rows and warming the caches."""
+        try:
+            await self.load()
+        except Exception as e:
+            logger.error(f"Error loading popular results: {e}")
+        ticks_per_warm = max(1, round(self.warm_interval / self.flush_interval))
+        tick = 0
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            tick += 1
+            try:
+                await self.flush()
+                today = _today()
+                if self._last_cleanup != today:
+                    await delete_chosen_results_before(today - timedelta(days=CHOSEN_RETENTION_DAYS))
+                    self._last_cleanup = today
+            except Exception as e:
+                logger.error(f"Error flushing chosen results: {e}")
+            if tick % ticks_per_warm == 0:
+                await self.warm()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'chosen': self.chosen,
+            'pending': sum(self._pending.values()),
+            'tracks': len(self._track_scores),
+            'queries': len(self._query_scores),
+            'warmed_searches': self.warmed_searches,
+            'warmed_links': self.warmed_links,
+            'queued_uploads': self.queued_uploads,
+        }
+
+
+popularity = PopularityTracker()
@@ -0,0 +1,55 @@
+import copy
+import os
+import re
+import unicodedata
+from typing import List
+
+from yandex_music import ClientAsync, Track
+
+from ..cache import TTLCache
+
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "20000"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "21600"))
+# Memory bound of the cache, in tracks over all cached results. A Track parsed from search
+# takes about 7 KB with minimal metadata and several times that with full album data.
+SEARCH_CACHE_MAX_TRACKS = int(os.getenv("SEARCH_CACHE_MAX_TRACKS", "20000"))
+# Results per inline answer; further pages are served from the cached search as the user scrolls
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "4"))
+
+_whitespace = re.compile(r'\s+')
+
+# Track metadata from search results, shared by all users.
+# Download info and direct links are short-lived and never cached here.
+# Results are weighed by their number of tracks, empty ones count as one.
+search_cache: TTLCache[List[Track]] = TTLCache(
+    maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL,
+    maxweight=SEARCH_CACHE_MAX_TRACKS, weigh=lambda tracks: max(1, len(tracks)),
+)
+
+
+def normalize_query(text: str) -> str:
+    """Fold case, Unicode forms and whitespace so equivalent queries share a cache entry."""
+    text = unicodedata.normalize('NFKC', text).casefold()
+    return _whitespace.sub(' ', text).strip()
+
+
+def _fresh_copy(track: Track, client: ClientAsync) -> Track:
+    """A copy of a cached track bound to the current client, without resolved download info."""
+    track = copy.copy(track)
+    track.client = client
+    track.download_info = None
+    return track
+
+
+async def search_tracks(client: ClientAsync, text: str, use_cache: bool = True) -> List[Track]:
+    """Search tracks, answering repeated queries from search_cache.
+
+    With use_cache=False the cache is not read, but the fresh result is still stored.
+    """
+    key = normalize_query(text)
+    tracks = search_cache.get(key) if use_cache else None
+    if tracks is None:
+        results = await client.search(text, type_='track')
+        tracks = results.tracks.results if results and results.tracks else []
+        search_cache.set(key, tracks)
+    return [_fresh_copy(track, client) for track in tracks]
@@ -0,0 +1,115 @@
+import asyncio
+import os
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Set
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from loguru import logger
+
+from ..cache import TTLCache
+from ..database.track_file_operations import file_id_cache, save_file_id
+
+# Chat the bot uploads audio to in order to get reusable file_ids. Uploads are disabled when unset.
+AUDIO_STORAGE_CHAT_ID = int(os.getenv("AUDIO_STORAGE_CHAT_ID", "0") or 0)
+AUDIO_UPLOAD_QUEUE_SIZE = int(os.getenv("AUDIO_UPLOAD_QUEUE_SIZE", "1000"))
+# Served tracks are remembered this long so a chosen result can still be uploaded
+SERVED_TRACK_TTL = float(os.getenv("SERVED_TRACK_TTL", "600"))
+
+
+@dataclass
+class ServedTrack:
+    url: str
+    title: str
+    performer: str
+    duration: int
+
+
+class AudioUploader:
+    """Uploads tracks users have sent to the storage chat and stores their Telegram file_ids.
+
+    Inline results with a direct link make Telegram download the track from Yandex every time.
+    Once a track is uploaded, later answers use its file_id instead.
+    """
+
+    def __init__(self, chat_id: int = AUDIO_STORAGE_CHAT_ID, queue_size: int = AUDIO_UPLOAD_QUEUE_SIZE):
+        self.chat_id = chat_id
+        self._served: TTLCache[ServedTrack] = TTLCache(maxsize=queue_size * 10, ttl=SERVED_TRACK_TTL)
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._queued: Set[str] = set()
+        self.uploaded = 0
+        self.failed = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.chat_id)
+
+    def served(self, track_id: str, url: str, title: str, performer: str, duration: int) -> None:
+        """Remember a track answered with a direct link."""
+        if self.enabled:
+            self._served.set(track_id, ServedTrack(url, title, performer, duration))
+
+    def chosen(self, track_id: str) -> None:
+        """Queue the upload of a track a user has just sent."""
+        if not self.enabled or track_id in self._queued or file_id_cache.get(track_id):
+            return
+        track = self._served.get(track_id)
+        if track is not None:
+            self.enqueue(track_id, track)
+
+    def enqueue(self, track_id: str, track: ServedTrack) -> bool:
+        """Queue the upload of a track unless it is already queued or the queue is full."""
+        if not self.enabled or track_id in self._queued:
+            return False
+        try:
+            self._queue.put_nowait((track_id, track))
+        except asyncio.QueueFull:
+            return False
+        self._queued.add(track_id)
+        return True
+
+    async def upload(self, bot: Bot, track_id: str, track: ServedTrack) -> Optional[str]:
+        # Telegram fetches the file from the direct link itself
+        message = await bot.send_audio(
+            chat_id=self.chat_id,
+            audio=track.url,
+            title=track.title,
+            performer=track.performer,
+            duration=track.duration,
+            disable_notification=True,
+        )
+        if not message.audio:
+            return None
+        await save_file_id(track_id, message.audio.file_id, message.audio.file_unique_id)
+        return message.audio.file_id
+
+    async def run(self, bot: Bot) -> None:
+        """Background task uploading queued tracks one by one."""
+        if not self.enabled:
+            return
+        while True:
+            track_id, track = await self._queue.get()
+            try:
+                if await self.upload(bot, track_id, track):
+                    self.uploaded += 1
+                else:
+                    self.failed += 1
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                self.failed += 1
+            except Exception as e:
+                logger.warning(f"Failed to upload track {track_id}: {e}")
+                self.failed += 1
+            finally:
+                self._queued.discard(track_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'enabled': self.enabled,
+            'queued': self._queue.qsize(),
+            'uploaded': self.uploaded,
+            'failed': self.failed,
+        }
+
+
+audio_uploader = AudioUploader()
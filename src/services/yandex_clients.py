@@ -0,0 +1,146 @@
+import asyncio
+import os
+from typing import Any, Dict, Optional
+
+import aiohttp
+from yandex_music import ClientAsync
+from yandex_music.exceptions import (
+    BadRequestError,
+    NetworkError,
+    NotFoundError,
+    TimedOutError,
+    UnauthorizedError,
+    YandexMusicError,
+)
+from yandex_music.utils.request_async import Request, USER_AGENT, default_timeout
+
+from ..cache import TTLCache
+from .http import http_pool
+from .metrics import upstream_call
+
+CLIENT_POOL_SIZE = int(os.getenv("CLIENT_POOL_SIZE", "5000"))
+CLIENT_IDLE_TTL = float(os.getenv("CLIENT_IDLE_TTL", "900"))
+# Yandex Music API base URL, the library default when unset
+YANDEX_MUSIC_API_URL = os.getenv("YANDEX_MUSIC_API_URL") or None
+
+
+class SessionRequest(Request):
+    """yandex_music Request that sends everything through the shared HTTP pool.
+
+    The stock Request opens a new session (and TCP/TLS connection) for every call.
+    """
+
+    async def _request_wrapper(self, *args, **kwargs):
+        with upstream_call('yandex'):
+            return await self._send(*args, **kwargs)
+
+    async def _send(self, *args, **kwargs):
+        # Mirrors Request._request_wrapper, but with a pooled session instead of aiohttp.request
+        if 'headers' not in kwargs:
+            kwargs['headers'] = {}
+
+        kwargs['headers']['User-Agent'] = USER_AGENT
+
+        if kwargs['timeout'] is default_timeout:
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=self._timeout)
+        else:
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=kwargs['timeout'])
+
+        try:
+            async with http_pool.session.request(*args, **kwargs) as resp:
+                content = await resp.content.read()
+        except asyncio.TimeoutError as e:
+            raise TimedOutError from e
+        except aiohttp.ClientError as e:
+            raise NetworkError(e) from e
+
+        if 200 <= resp.status <= 299:
+            return content
+
+        try:
+            parse = self._parse(content)
+            message = parse.get_error()
+        except YandexMusicError:
+            message = 'Unknown HTTPError'
+
+        if resp.status in (401, 403):
+            raise UnauthorizedError(message)
+        if resp.status == 400:
+            raise BadRequestError(message)
+        if resp.status == 404:
+            raise NotFoundError(message)
+        if resp.status in (409, 413):
+            raise NetworkError(message)
+
+        if resp.status == 502:
+            raise NetworkError('Bad Gateway')
+
+        raise NetworkError(f'{message} ({resp.status}): {content}')
+
+
+class ClientPool:
+    """Initialized ClientAsync instances keyed by token.
+
+    Clients are evicted when least recently used or idle for longer than idle_ttl,
+    and all of them use the shared HTTP pool so connections are kept alive between queries.
+    """
+
+    def __init__(self, maxsize: int = CLIENT_POOL_SIZE, idle_ttl: float = CLIENT_IDLE_TTL):
+        self.idle_ttl = idle_ttl
+        self._clients: TTLCache[ClientAsync] = TTLCache(maxsize=maxsize, ttl=idle_ttl)
+        self._pending: Dict[str, asyncio.Task] = {}
+
+    def create_client(self, token: str) -> ClientAsync:
+        """Create a client that uses the shared HTTP pool. The client is not initialized."""
+        return ClientAsync(token=token, base_url=YANDEX_MUSIC_API_URL, request=SessionRequest())
+
+    async def get(self, token: str) -> ClientAsync:
+        """Get an initialized client for the token, creating and init()-ing it if needed."""
+        client = self._clients.get(token)
+        if client is not None:
+            # Refresh idle expiry
+            self._clients.set(token, client)
+            return client
+
+        # Several queries with the same token share one init() call. It runs in its own task,
+        # so a waiter that is cancelled, e.g. a superseded inline query, doesn't cancel the others.
+        task = self._pending.get(token)
+        if task is None:
+            task = self._pending[token] = asyncio.create_task(self._init(token))
+            # Mark the exception as retrieved when nobody waits for it anymore
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return await asyncio.shield(task)
+
+    async def _init(self, token: str) -> ClientAsync:
+        task = asyncio.current_task()
+        try:
+            client = await self.create_client(token).init()
+            # A token invalidated meanwhile must not get its client back
+            if self._pending.get(token) is task:
+                self._clients.set(token, client)
+            return client
+        finally:
+            if self._pending.get(token) is task:
+                del self._pending[token]
+
+    def put(self, token: str, client: ClientAsync) -> None:
+        """Add an already initialized client, e.g. one used to validate a new token."""
+        self._clients.set(token, client)
+
+    def invalidate(self, token: Optional[str]) -> None:
+        """Forget the client for a revoked or replaced token."""
+        if token:
+            self._clients.pop(token)
+            self._pending.pop(token, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return self._clients.stats()
+
+    def close(self) -> None:
+        self._clients.clear()
+        for task in self._pending.values():
+            task.cancel()
+        self._pending.clear()
+
+
+client_pool = ClientPool()
@@ -0,0 +1,324 @@
+import asyncio
+import json
+import os
+import random
+import string
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import aiohttp
+from loguru import logger
+
+from .http import HttpPool, http_pool
+from .metrics import upstream_call
+
+YNISON_REDIRECT_URL = os.getenv(
+    "YNISON_REDIRECT_URL",
+    "wss://ynison.music.yandex.ru/redirector.YnisonRedirectService/GetRedirectToYnison",
+)
+# {host} is replaced with the host returned by the redirector
+YNISON_STATE_URL = os.getenv(
+    "YNISON_STATE_URL",
+    "wss://{host}/ynison_state.YnisonStateService/PutYnisonState",
+)
+
+# How long a redirect host/ticket is reused before asking the redirector again
+YNISON_REDIRECT_TTL = float(os.getenv("YNISON_REDIRECT_TTL", "600"))
+# Warm state connections are closed after this many seconds without lookups
+YNISON_IDLE_TIMEOUT = float(os.getenv("YNISON_IDLE_TIMEOUT", "300"))
+YNISON_RECEIVE_TIMEOUT = float(os.getenv("YNISON_RECEIVE_TIMEOUT", "10"))
+# Warm sessions kept at once; also the size of the connector their websockets use,
+# so every session can hold a connection without waiting for another to close
+YNISON_MAX_CONNECTIONS = int(os.getenv("YNISON_MAX_CONNECTIONS", "1000"))
+
+
+class YnisonError(Exception):
+    pass
+
+
+def _make_ws_proto(device_id: str, redirect_ticket: Optional[str] = None) -> Dict[str, str]:
+    device_info = {
+        "app_name": "Chrome",
+        "type": 1,
+    }
+    ws_proto = {
+        "Ynison-Device-Id": device_id,
+        "Ynison-Device-Info": json.dumps(device_info),
+    }
+    if redirect_ticket:
+        ws_proto["Ynison-Redirect-Ticket"] = redirect_ticket
+    return ws_proto
+
+
+def _make_headers(token: str, ws_proto: Dict[str, str]) -> Dict[str, str]:
+    return {
+        "Sec-WebSocket-Protocol": f"Bearer, v2, {json.dumps(ws_proto)}",
+        "Origin": "http://music.yandex.ru",
+        "Authorization": f"OAuth {token}",
+    }
+
+
+def _make_initial_state(device_id: str) -> Dict[str, Any]:
+    return {
+        "update_full_state": {
+            "player_state": {
+                "player_queue": {
+                    "current_playable_index": -1,
+                    "entity_id": "",
+                    "entity_type": "VARIOUS",
+                    "playable_list": [],
+                    "options": {"repeat_mode": "NONE"},
+                    "entity_context": "BASED_ON_ENTITY_BY_DEFAULT",
+                    "version": {
+                        "device_id": device_id,
+                        "version": 9021243204784341000,
+                        "timestamp_ms": 0,
+                    },
+                    "from_optional": "",
+                },
+                "status": {
+                    "duration_ms": 0,
+                    "paused": True,
+                    "playback_speed": 1,
+                    "progress_ms": 0,
+                    "version": {
+                        "device_id": device_id,
+                        "version": 8321822175199937000,
+                        "timestamp_ms": 0,
+                    },
+                },
+            },
+            "device": {
+                "capabilities": {
+                    "can_be_player": True,
+                    "can_be_remote_controller": False,
+                    "volume_granularity": 16,
+                },
+                "info": {
+                    "device_id": device_id,
+                    "type": "WEB",
+                    "title": "Chrome Browser",
+                    "app_name": "Chrome",
+                },
+                "volume_info": {"volume": 0},
+                "is_shadow": True,
+            },
+            "is_currently_active": False,
+        },
+        "rid": "ac281c26-a047-4419-ad00-e4fbfda1cba3",
+        "player_action_timestamp_ms": 0,
+        "activity_interception_type": "DO_NOT_INTERCEPT_BY_DEFAULT",
+    }
+
+
+class YnisonSession:
+    """A warm PutYnisonState connection for one token, kept up to date by pushed messages."""
+
+    def __init__(self, manager: 'YnisonManager', token: str):
+        self.manager = manager
+        self.token = token
+        self.device_id = "".join(random.choice(string.ascii_lowercase) for _ in range(16))
+        self.state: Optional[Dict[str, Any]] = None
+        # Monotonic time of the last state received from Ynison
+        self.state_received_at = 0.0
+        self.last_used = time.monotonic()
+        self._redirect: Optional[Dict[str, str]] = None
+        self._redirect_expires_at = 0.0
+        self._ws: Optional[aiohttp.ClientWebSocketResponse] = None
+        self._reader: Optional[asyncio.Task] = None
+        self._first_state: Optional[asyncio.Future] = None
+        self._connect_lock = asyncio.Lock()
+
+    @property
+    def connected(self) -> bool:
+        return self._ws is not None and not self._ws.closed
+
+    async def _get_redirect(self) -> Dict[str, str]:
+        if self._redirect and self._redirect_expires_at > time.monotonic():
+            return self._redirect
+
+        self.manager.redirects += 1
+        with upstream_call('ynison_redirect'):
+            ws = await asyncio.wait_for(
+                http_pool.session.ws_connect(
+                    url=YNISON_REDIRECT_URL,
+                    headers=_make_headers(self.token, _make_ws_proto(self.device_id)),
+                ),
+                timeout=YNISON_RECEIVE_TIMEOUT,
+            )
+            async with ws:
+                recv = await asyncio.wait_for(ws.receive(), timeout=YNISON_RECEIVE_TIMEOUT)
+                data = json.loads(recv.data)
+
+        if "redirect_ticket" not in data or "host" not in data:
+            raise YnisonError(f"Invalid response structure: {data}")
+
+        self._redirect = {"host": data["host"], "redirect_ticket": data["redirect_ticket"]}
+        self._redirect_expires_at = time.monotonic() + YNISON_REDIRECT_TTL
+        return self._redirect
+
+    async def _open_state_ws(self) -> aiohttp.ClientWebSocketResponse:
+        for attempt in range(2):
+            redirect = await self._get_redirect()
+            try:
+                return await asyncio.wait_for(
+                    self.manager.http_pool.session.ws_connect(
+                        url=YNISON_STATE_URL.format(host=redirect["host"]),
+                        headers=_make_headers(self.token, _make_ws_proto(self.device_id, redirect["redirect_ticket"])),
+                        method="GET",
+                        heartbeat=30,
+                    ),
+                    timeout=YNISON_RECEIVE_TIMEOUT,
+                )
+            except aiohttp.WSServerHandshakeError:
+                # The cached ticket is no longer valid, ask the redirector again
+                self._redirect = None
+                if attempt:
+                    raise
+        raise YnisonError("Unreachable")
+
+    async def connect(self) -> None:
+        async with self._connect_lock:
+            if self.connected:
+                return
+            self.manager.connects += 1
+            ws = await self._open_state_ws()
+            self._ws = ws
+            self._first_state = asyncio.get_running_loop().create_future()
+            self._reader = asyncio.create_task(self._read(ws, self._first_state))
+            await ws.send_str(json.dumps(_make_initial_state(self.device_id)))
+
+    async def _read(self, ws: aiohttp.ClientWebSocketResponse, first_state: asyncio.Future) -> None:
+        try:
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                data = json.loads(msg.data)
+                if "player_state" not in data:
+                    continue
+                self.state = data
+                self.state_received_at = time.monotonic()
+                if not first_state.done():
+                    first_state.set_result(data)
+        except Exception as e:
+            logger.debug(f"Ynison connection closed: {e}")
+        finally:
+            if not first_state.done():
+                first_state.set_exception(YnisonError("Connection closed before the first state"))
+                first_state.exception()
+            if self._ws is ws:
+                # A stale state must not be served once the stream has stopped
+                self.state = None
+
+    async def get_state(self) -> Tuple[Dict[str, Any], float]:
+        """Latest player state and the monotonic time it was received.
+
+        A memory read when the connection is warm.
+        """
+        self.last_used = time.monotonic()
+        if self.connected and self.state is not None:
+            self.manager.warm_hits += 1
+            return self.state, self.state_received_at
+
+        with upstream_call('ynison_state'):
+            await self.connect()
+            state = await asyncio.wait_for(asyncio.shield(self._first_state), timeout=YNISON_RECEIVE_TIMEOUT)
+        return state, self.state_received_at
+
+    async def close(self) -> None:
+        if self._reader is not None:
+            self._reader.cancel()
+            self._reader = None
+        if self._ws is not None:
+            await self._ws.close()
+            self._ws = None
+        self.state = None
+
+
+class YnisonManager:
+    """Keeps Ynison sessions of recently active users and closes idle ones."""
+
+    def __init__(self, idle_timeout: float = YNISON_IDLE_TIMEOUT, max_connections: int = YNISON_MAX_CONNECTIONS):
+        self.idle_timeout = idle_timeout
+        self.max_connections = max_connections
+        # Warm state websockets hold their connections for as long as they live, so they get a
+        # connector of their own sized to the session cap; the one-shot redirector calls use http_pool
+        self.http_pool = HttpPool(limit=max_connections, limit_per_host=max_connections)
+        self._sessions: Dict[str, YnisonSession] = {}
+        self.warm_hits = 0
+        self.connects = 0
+        self.redirects = 0
+
+    async def get_state(self, token: str) -> Tuple[Dict[str, Any], float]:
+        session = self._sessions.get(token)
+        # The cap is strict: one session more than the connector holds would wait for a connection
+        while session is None and len(self._sessions) >= self.max_connections:
+            await self._close_least_recently_used()
+            # A concurrent call may have created the token's session meanwhile
+            session = self._sessions.get(token)
+        if session is None:
+            session = self._sessions[token] = YnisonSession(self, token)
+        try:
+            return await session.get_state()
+        except Exception:
+            # Only drop the session that failed, not a newer one stored meanwhile
+            if self._sessions.get(token) is session:
+                await self.invalidate(token)
+            else:
+                await session.close()
+            raise
+
+    def current_playable_id(self, token: str) -> Optional[str]:
+        """Id of the current track in the token's warm state, '' when nothing plays.
+
+        None when there is no warm connection. Never goes to the network.
+        """
+        session = self._sessions.get(token)
+        if session is None or not session.connected or session.state is None:
+            return None
+        queue = session.state["player_state"]["player_queue"]
+        index = queue["current_playable_index"]
+        if index < 0 or index >= len(queue["playable_list"]):
+            return ''
+        return str(queue["playable_list"][index]["playable_id"])
+
+    async def invalidate(self, token: Optional[str]) -> None:
+        """Close the session of a revoked or replaced token."""
+        session = self._sessions.pop(token, None) if token else None
+        if session is not None:
+            await session.close()
+
+    async def _close_least_recently_used(self) -> None:
+        token = min(self._sessions, key=lambda t: self._sessions[t].last_used)
+        await self.invalidate(token)
+
+    async def close_idle(self) -> None:
+        deadline = time.monotonic() - self.idle_timeout
+        for token in [t for t, s in self._sessions.items() if s.last_used < deadline]:
+            await self.invalidate(token)
+
+    async def run(self) -> None:
+        """Background task closing idle connections."""
+        while True:
+            await asyncio.sleep(min(self.idle_timeout, 60))
+            try:
+                await self.close_idle()
+            except Exception as e:
+                logger.error(f"Error closing idle Ynison sessions: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'sessions': len(self._sessions),
+            'connected': sum(1 for s in self._sessions.values() if s.connected),
+            'warm_hits': self.warm_hits,
+            'connects': self.connects,
+            'redirects': self.redirects,
+        }
+
+    async def close(self) -> None:
+        for token in list(self._sessions):
+            await self.invalidate(token)
+        await self.http_pool.close()
+
+
+ynison_manager = YnisonManager()
@@ -0,0 +1,186 @@
+"""Webhook serving mode.
+
+With WEBHOOK_WORKERS=1 the bot process serves the webhook itself. With more workers the
+main process only routes: it reads the user id of each update and forwards the update over
+a unix socket to the worker chosen by that id, so all updates of a user are handled by the
+same process, in order, and its caches and warm connections stay in one place.
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import tempfile
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from loguru import logger
+
+# Public base URL Telegram sends updates to, e.g. https://bot.example.com
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "1"))
+# Parallel connections Telegram may open to the webhook
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "100"))
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def extract_user_id(update: Dict[str, Any]) -> Optional[int]:
+    """The id of the user an update comes from, whatever its type."""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        sender = value.get('from') or value.get('user') or value.get('chat')
+        if isinstance(sender, dict) and 'id' in sender:
+            return sender['id']
+    return None
+
+
+def worker_socket(directory: str, index: int) -> str:
+    return os.path.join(directory, f'worker-{index}.sock')
+
+
+async def set_webhook(bot: Bot, dp: Dispatcher) -> None:
+    await bot.set_webhook(
+        url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+
+
+async def serve_dispatcher(bot: Bot, dp: Dispatcher, path: Optional[str] = None) -> None:
+    """Serve updates with aiogram's request handler until cancelled.
+
+    Listens on the public host/port, or on the unix socket path when run as a worker.
+    Secret token checks are done by the router in that case.
+    """
+    app = web.Application()
+    secret = WEBHOOK_SECRET if path is None else None
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret).register(app, path=WEBHOOK_PATH)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    if path is None:
+        site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    else:
+        site = web.UnixSite(runner, path)
+    await site.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+class UpdateRouter:
+    """Forwards webhook updates to worker processes by user id."""
+
+    def __init__(self, sockets: List[str]):
+        self.sockets = sockets
+        self._sessions: List[aiohttp.ClientSession] = []
+
+    async def start(self) -> None:
+        self._sessions = [
+            aiohttp.ClientSession(connector=aiohttp.UnixConnector(path=path, limit=0))
+            for path in self.sockets
+        ]
+
+    async def close(self) -> None:
+        for session in self._sessions:
+            await session.close()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get(SECRET_HEADER) != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        body = await request.read()
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+        user_id = extract_user_id(update)
+        key = user_id if user_id is not None else update.get('update_id', 0)
+        session = self._sessions[key % len(self._sessions)]
+        try:
+            async with session.post(f'http://worker{WEBHOOK_PATH}', data=body,
+                                    headers={'Content-Type': 'application/json'}) as resp:
+                return web.Response(status=resp.status, body=await resp.read(), content_type=resp.content_type)
+        except aiohttp.ClientError as e:
+            # Telegram retries the update later
+            logger.warning(f"Failed to forward update to a worker: {e}")
+            return web.Response(status=502)
+
+
+async def _wait_for_sockets(sockets: List[str], processes: List[multiprocessing.Process], timeout: float = 60) -> None:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not all(os.path.exists(path) for path in sockets):
+        if any(not process.is_alive() for process in processes):
+            raise RuntimeError("A webhook worker exited during startup")
+        if loop.time() > deadline:
+            raise RuntimeError("Webhook workers did not start in time")
+        await asyncio.sleep(0.1)
+
+
+async def run_router(sockets: List[str], processes: List[multiprocessing.Process],
+                     setup: Callable[[], Awaitable[None]]) -> None:
+    """Accept webhook requests on the public port and forward them to the workers until cancelled."""
+    await _wait_for_sockets(sockets, processes)
+    router = UpdateRouter(sockets)
+    await router.start()
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, router.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    await setup()
+    logger.info(f"Routing webhook updates on {WEBHOOK_HOST}:{WEBHOOK_PORT} to {len(sockets)} workers")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await router.close()
+
+
+def run_workers(worker: Callable[[int, str], None], setup: Callable[[], Awaitable[None]],
+                workers: int = WEBHOOK_WORKERS, prepare: Optional[Callable[[], Awaitable[None]]] = None) -> None:
+    """Start the worker processes and route updates to them until interrupted.
+
+    prepare() runs once before any worker starts, e.g. to create the database tables;
+    worker(index, socket_path) runs in a fresh process and serves the socket;
+    setup() runs in the router once all workers listen, e.g. to register the webhook.
+    """
+    if prepare is not None:
+        asyncio.run(prepare())
+    directory = tempfile.mkdtemp(prefix='ymbot-')
+    sockets = [worker_socket(directory, index) for index in range(workers)]
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=worker, args=(index, path), daemon=True) for index, path in enumerate(sockets)]
+    for process in processes:
+        process.start()
+
+    async def route() -> None:
+        task = asyncio.current_task()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, task.cancel)
+        await run_router(sockets, processes, setup)
+
+    try:
+        asyncio.run(route())
+    except asyncio.CancelledError:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(timeout=30)
+        for path in sockets:
+            if os.path.exists(path):
+                os.remove(path)
+        os.rmdir(directory)